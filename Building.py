@@ -15,9 +15,9 @@ class Building:
     """
     A class to represent a building
     """
-    def __init__(self, json_path, name):
+    def __init__(self, json_path, name, cache_dir=None):
         self.name = name
-        self.grammar = Grammar(json_path)
+        self.grammar = Grammar(json_path, cache_dir)
 
     def generate_fact(self, start_symbol) -> str:
         """
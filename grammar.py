@@ -6,10 +6,33 @@ Parses and generates grammar for koffee
 @date: 05/14/2021
 '''
 
+import glob
+import hashlib
 import json
+import os
+import pickle
 import random
+import re
 import sys
 
+# opcodes of the compiled instructions, see Grammar.compile
+TEXT = 0 # append the string arg to the output
+CALL = 1 # expand a random alternative of the compiled rule arg
+NAMED = 2 # arg is (name, compiled rule or None): the variable name if it is set, else the rule
+MARK = 3 # remember where the value of the next SET starts in the output
+SET = 4 # move the output since the last MARK into the variable arg
+SET_TEXT = 5 # arg is (key, string): set the variable key to the string
+
+# how deep expand() goes before it decides the grammar never ends
+MAX_EXPANSION_DEPTH = 1 << 16
+
+# the chunks of a production rule: #nonterminal#, [key:value], plain text, 
+# or a # or [ that starts none of them
+RULE_PATTERN = re.compile(r"#(?P<call>[^#]*)#|\[(?P<key>[^:\]]*):(?P<value>[^\]]*)\]|(?P<text>[^#\[]+)|(?P<error>[#\[])")
+
+# bump when the parsed classes change so old cached grammars are reparsed
+GRAMMAR_CACHE_VERSION = 1
+
 class NonterminalSymbol:
 	def __init__(self):
 		self.rules = [] # list of ProductionRules
@@ -45,20 +68,83 @@ class Set_Variable:
 		self.value = value # string/Call_Promise/Set_Variable
 
 
-class Parse_Result:
-	def __init__(self, body, left_string):
-		self.left_string = left_string #string
-		self.body = body #list
+class Grammar:
+	def __init__(self, json_path, cache_dir=None):
+		"""
+		Parses the grammar of a json file and compiles it.
 
+		If a cache_dir is given, the grammar parsed earlier from the same path 
+		and the same content is loaded from it instead of parsing the json 
+		again, and newly parsed grammars are saved there for the next start.
 
-class Grammar:
-	def __init__(self, json_path):
-		with open(json_path, 'r') as json_file:
-			data = json.load(json_file)
+		Parameters:
+		json_path: the path to the json file of the grammar
+		cache_dir (optional): the directory holding cached grammars
+		"""
+		with open(json_path, 'rb') as json_file:
+			content = json_file.read()
 		self.grammars_dict = {} # string -> NonterminalSymbol
 		self.variables = {}
+		self.parsed_data = None
+
+		cache_path = None
+		if cache_dir is not None:
+			cache_path = self.cache_path(json_path, content, cache_dir)
+		if cache_path is None or not self.load(cache_path):
+			self.parsed_data = self.parse_json(json.loads(content))
+			if cache_path is not None:
+				self.save(cache_path)
+		self.compile()
+
+
+	def cache_path(self, json_path, content, cache_dir):
+		"""
+		Returns the path of the cached grammar for this json file.
+		The file name is keyed by the path and by the hash of the content,
+		so editing the json invalidates the cache.
+		"""
+		path_hash = hashlib.sha1(os.path.abspath(json_path).encode()).hexdigest()[:8]
+		name = "{name}_{path}_{content}_v{version}.pickle".format(
+			name=os.path.splitext(os.path.basename(json_path))[0], path=path_hash, 
+			content=hashlib.sha1(content).hexdigest()[:20], version=GRAMMAR_CACHE_VERSION)
+		return os.path.join(cache_dir, name)
+
 
-		self.parsed_data = self.parse_json(data)
+	def save(self, path):
+		"""
+		Saves the parsed self.grammars_dict to a pickle file that load() reads,
+		and removes the files cached for older versions of the same json.
+		The file is written under a temporary name and renamed, as in SLM.save
+		"""
+		os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+		tmp_path = "{}.{}.tmp".format(path, os.getpid())
+		with open(tmp_path, "wb") as file:
+			pickle.dump(self.grammars_dict, file, pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp_path, path)
+
+		# the name up to the content hash is the same for every version of the json
+		prefix = path.rsplit("_", 2)[0] + "_"
+		for stale_path in glob.glob(glob.escape(prefix) + "*.pickle"):
+			if stale_path != path:
+				os.remove(stale_path)
+
+
+	def load(self, path):
+		"""
+		Loads self.grammars_dict from a file written by save()
+
+		Returns:
+		False if there is no such file or it can't be read, True otherwise
+		"""
+		try:
+			with open(path, "rb") as file:
+				grammars_dict = pickle.load(file)
+		except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+			return False
+		if type(grammars_dict) != dict:
+			return False
+		self.grammars_dict = grammars_dict
+		return True
 
 
 	def get_string_from_token(self, token):
@@ -124,12 +210,16 @@ class Grammar:
 
 	def set_variable(self, key, token):
 		self.variables[key] = self.get_string_from_token(token)
+		if key not in self.variable_keys and key in self.grammars_dict:
+			# the compiled calls of the symbol have to look for the variable now
+			self.variable_keys.add(key)
+			self.compile()
 
 
 	def generate(self, start_symbol):
 		"""
 		Generates text based on the grammar loaded and stored in this program.
-		It uses the get_string_from_production_rule() as a helper function
+		It runs the compiled rules with expand() as a helper function
 		
 		Parameters: 
 		start_symbol: a string to start the sentence
@@ -139,91 +229,446 @@ class Grammar:
 		if start_symbol not in self.grammars_dict:
 			sys.exit("ERROR: Invalid start_symbol.")
 
-		random_production_rule = random.choice(self.grammars_dict[start_symbol].rules)
-		return self.get_string_from_production_rule(random_production_rule)
+		return self.expand(self.compiled_dict[start_symbol])
 
 
-	def parse_value(self, value, body):
+	def compile(self):
 		"""
-		Parse the String formatted production rule and append it to the body list
-		
-		Note that this function only parses out one chunck of the string, the rest of the string
-		will be returned.
+		Compiles the parsed self.grammars_dict into self.compiled_dict, which 
+		maps every symbol to the list of its alternatives, each a flat list of
+		(opcode, arg) instructions that expand() runs, or just the string for
+		the alternatives that are plain text.
+
+		The calls of symbols are linked straight to the compiled alternatives
+		of the symbol. Only the calls of names that can be variables (the keys
+		of a Set_Variable, the variables already set, or names that are not 
+		symbols) look into self.variables first, when they are run.
+		Then the static symbols are folded into constant strings, see fold(),
+		and the expansions of the symbols are counted, see count_expansions().
+		"""
+		self.compiled_dict = {symbol: [] for symbol in self.grammars_dict}
+		# the symbol of the compiled alternatives a CALL links to
+		self.symbol_of = {id(alternatives): symbol for symbol, alternatives in self.compiled_dict.items()}
+		self.variable_keys = set(self.variables)
+		self.folded_calls = 0
+		for nonterminal in self.grammars_dict.values():
+			for production_rule in nonterminal.rules:
+				for token in production_rule.body:
+					if type(token) == Set_Variable:
+						self.variable_keys.add(token.key)
+
+		for symbol, nonterminal in self.grammars_dict.items():
+			alternatives = self.compiled_dict[symbol]
+			for production_rule in nonterminal.rules:
+				alternatives.append(self.compile_body(production_rule.body))
+		self.fold()
+		self.count_expansions()
+
+
+	def compile_body(self, body):
+		"""
+		Helper function for compile()
+		Compiles the body of a production rule into a list of instructions
+		"""
+		instructions = []
+		for token in body:
+			if type(token) == str:
+				instructions.append((TEXT, token))
+
+			elif type(token) == Call_Promise:
+				instructions.append(self.compile_call(token.value))
+
+			elif type(token) == Set_Variable:
+				if type(token.value) == Call_Promise:
+					instructions.append((MARK, None))
+					instructions.append(self.compile_call(token.value.value))
+					instructions.append((SET, token.key))
+				else:
+					instructions.append((SET_TEXT, (token.key, token.value)))
+		return instructions
+
+
+	def fold(self):
+		"""
+		Helper function for compile()
+		Folds the constants of the compiled grammar: a symbol is static when
+		it has one alternative made of strings and calls of static symbols, 
+		and is not a variable. Its alternative is folded into one string, and
+		the calls of static symbols in every other alternative are folded into
+		the strings around them.
+		The static symbols are folded callees first (see dependency_order), 
+		so cycles are never static.
+		"""
+		callees_of = {}
+		for symbol, alternatives in self.compiled_dict.items():
+			if len(alternatives) != 1 or symbol in self.variable_keys:
+				continue
+			if any(opcode != TEXT and opcode != CALL for opcode, arg in alternatives[0]):
+				continue
+			callees_of[symbol] = {self.symbol_of[id(arg)] for opcode, arg in alternatives[0] if opcode == CALL}
+
+		for symbol in self.dependency_order(callees_of):
+			alternatives = self.compiled_dict[symbol]
+			alternatives[0] = self.fold_body(alternatives[0])
+
+		for alternatives in self.compiled_dict.values():
+			for i in range(len(alternatives)):
+				if type(alternatives[i]) is list:
+					alternatives[i] = self.fold_body(alternatives[i])
+
+
+	def dependency_order(self, callees_of):
+		"""
+		Helper function for fold() and count_expansions()
+		Yields the symbols of callees_of (symbol -> the set of symbols it calls)
+		callees first: starting from the ones that call no other symbol, a 
+		symbol is yielded once every symbol it calls was. The symbols on a 
+		cycle, or calling a symbol left out of callees_of, are never yielded
+		"""
+		waiting = {} # symbol -> how many of the symbols it calls were not yielded yet
+		callers = {} # symbol -> the symbols waiting for it
+		ready = []
+		for symbol, callees in callees_of.items():
+			waiting[symbol] = len(callees)
+			for callee in callees:
+				callers.setdefault(callee, []).append(symbol)
+			if not callees:
+				ready.append(symbol)
+
+		while ready:
+			symbol = ready.pop()
+			yield symbol
+			for caller in callers.get(symbol, []):
+				waiting[caller] -= 1
+				if waiting[caller] == 0:
+					ready.append(caller)
+
+
+	def fold_body(self, instructions):
+		"""
+		Helper function for fold()
+		Folds the calls of static symbols of a list of instructions into TEXT,
+		merges the strings next to each other, and turns a variable set to a 
+		string into a SET_TEXT.
+
+		Return:
+		the string if all the instructions were folded into one, or the folded list
+		"""
+		folded = []
+		for opcode, arg in instructions:
+			if opcode == CALL and len(arg) == 1 and type(arg[0]) is str:
+				opcode, arg = TEXT, arg[0]
+				self.folded_calls += 1
+
+			if opcode == TEXT and folded and folded[-1][0] == TEXT:
+				folded[-1] = (TEXT, folded[-1][1] + arg)
+			elif opcode == SET and folded[-1][0] == TEXT and folded[-2][0] == MARK:
+				folded[-2:] = [(SET_TEXT, (arg, folded[-1][1]))]
+			else:
+				folded.append((opcode, arg))
+
+		if not folded:
+			return ""
+		if len(folded) == 1 and folded[0][0] == TEXT:
+			return folded[0][1]
+		return folded
+
+
+	def stats(self):
+		"""
+		Returns how much of the compiled grammar is constant, see fold()
+
+		Return:
+		a dict of the number of symbols and of alternatives, how many of them
+		are constant strings, how many calls were folded into strings, how
+		many calls are left to expand and how many symbols have a countable 
+		number of expansions (see count_expansions())
+		"""
+		alternatives = [body for rule in self.compiled_dict.values() for body in rule]
+		constant_symbols = sum(1 for rule in self.compiled_dict.values() if len(rule) == 1 and type(rule[0]) is str)
+		constant_alternatives = sum(1 for body in alternatives if type(body) is str)
+		calls = sum(1 for body in alternatives if type(body) is list 
+			for opcode, arg in body if opcode == CALL or opcode == NAMED)
+		return {
+			"symbols": len(self.compiled_dict),
+			"constant_symbols": constant_symbols,
+			"alternatives": len(alternatives),
+			"constant_alternatives": constant_alternatives,
+			"folded_calls": self.folded_calls,
+			"calls": calls,
+			"countable_symbols": len(self.expansion_counts),
+		}
+
+
+	def count_expansions(self):
+		"""
+		Helper function for compile()
+		Counts the expansions of every symbol into self.expansion_counts: 
+		symbol -> the number of expansions of each of its alternatives, the 
+		product of the counts of the symbols an alternative calls.
+		Symbols that may use variables or call themselves can't be counted
+		and are left out. Like fold(), the symbols are counted callees first
+		(see dependency_order).
+		"""
+		self.expansion_counts = {}
+		callees_of = {}
+		for symbol, alternatives in self.compiled_dict.items():
+			bodies = [body for body in alternatives if type(body) is list]
+			if any(opcode != TEXT and opcode != CALL for body in bodies for opcode, arg in body):
+				continue
+			callees_of[symbol] = {self.symbol_of[id(arg)] for body in bodies for opcode, arg in body if opcode == CALL}
+
+		for symbol in self.dependency_order(callees_of):
+			counts = []
+			for body in self.compiled_dict[symbol]:
+				count = 1
+				if type(body) is list:
+					for opcode, arg in body:
+						if opcode == CALL:
+							count *= sum(self.expansion_counts[self.symbol_of[id(arg)]])
+				counts.append(count)
+			self.expansion_counts[symbol] = counts
+
+
+	def expansion_count(self, symbol):
+		"""
+		Returns how many expansions the symbol has, or None if it can't be 
+		counted because it may use variables or never end
+		Expansions that come from different choices count as different even
+		when the grammar makes them the same string.
+		"""
+		if symbol not in self.grammars_dict:
+			sys.exit("ERROR: Invalid start_symbol.")
+		if symbol not in self.expansion_counts:
+			return None
+		return sum(self.expansion_counts[symbol])
+
+
+	def unrank(self, symbol, index):
+		"""
+		Returns the expansion number index of the symbol, between 0 and 
+		expansion_count(symbol) - 1. The index picks the alternative, then 
+		its digits, the counts of the called symbols being the bases, pick
+		the expansion of every call, the last call changing the fastest.
+		"""
+		output = []
+		stack = [iter(self.unrank_body(symbol, index))]
+		while stack:
+			for opcode, arg, sub_index in stack[-1]:
+				if opcode == TEXT:
+					output.append(arg)
+				else:
+					stack.append(iter(self.unrank_body(self.symbol_of[id(arg)], sub_index)))
+					break
+			else:
+				stack.pop()
+		return "".join(output)
+
+
+	def unrank_body(self, symbol, index):
+		"""
+		Helper function for unrank()
+		Returns the instructions of the alternative of the symbol that the 
+		index picks, as (opcode, arg, index of the call's expansion) tuples
+		"""
+		alternatives = self.compiled_dict[symbol]
+		counts = self.expansion_counts[symbol]
+		i = 0
+		while index >= counts[i]:
+			index -= counts[i]
+			i += 1
+		body = alternatives[i]
+		if type(body) is str:
+			return [(TEXT, body, None)]
+
+		instructions = []
+		for opcode, arg in reversed(body):
+			sub_index = None
+			if opcode == CALL:
+				count = sum(self.expansion_counts[self.symbol_of[id(arg)]])
+				index, sub_index = divmod(index, count)
+			instructions.append((opcode, arg, sub_index))
+		instructions.reverse()
+		return instructions
+
+
+	def enumerate(self, symbol):
+		"""
+		Generates every expansion of the symbol once, in the order of unrank()
+
+		Parameters:
+		symbol: a symbol whose expansions can be counted, see expansion_count()
+
+		Return:
+		a generator of the strings
+		"""
+		count = self.countable_expansions(symbol)
+		for index in range(count):
+			yield self.unrank(symbol, index)
+
+
+	def sample_distinct(self, symbol, k):
+		"""
+		Draws k expansions of the symbol at random without replacement: k 
+		different indices are drawn from the expansion count and unranked, 
+		see unrank(), so no expansion is drawn twice and none is rejected
+
+		Parameters:
+		symbol: a symbol whose expansions can be counted, see expansion_count()
+		k: how many expansions to draw
+
+		Return:
+		a list of k strings, in random order
+		"""
+		count = self.countable_expansions(symbol)
+		if k > count:
+			sys.exit("ERROR: {} has {} expansions, fewer than {}.".format(symbol, count, k))
+		if count <= sys.maxsize:
+			indices = random.sample(range(count), k)
+		else:
+			# range() can't be sampled past sys.maxsize, but then two equal draws
+			# are so unlikely that drawing again is free
+			indices = set()
+			while len(indices) < k:
+				indices.add(random.randrange(count))
+			indices = list(indices)
+		return [self.unrank(symbol, index) for index in indices]
+
+
+	def countable_expansions(self, symbol):
+		"""
+		Helper function for enumerate() and sample_distinct()
+		Returns the expansion count of the symbol, exits if it can't be counted
+		"""
+		count = self.expansion_count(symbol)
+		if count is None:
+			sys.exit("ERROR: The expansions of {} can't be counted, it may use variables or never end.".format(symbol))
+		return count
+
+
+	def compile_call(self, name):
+		"""
+		Helper function for compile_body()
+		Compiles the call of a name, linked to the compiled alternatives of the symbol
+		"""
+		if name in self.compiled_dict and name not in self.variable_keys:
+			return (CALL, self.compiled_dict[name])
+		return (NAMED, (name, self.compiled_dict.get(name)))
+
+
+	def expand(self, alternatives):
+		"""
+		Runs the instructions of a random alternative of a compiled rule (see
+		compile()) and returns the string generated. 
+		The rules called are expanded with an explicit stack, so deep grammars
+		do not reach the recursion limit, and the output goes to one buffer.
+
+		Parameters:
+		alternatives: a value of self.compiled_dict
+
+		Return:
+		the string generated
+		"""
+		random_float = random.random
+		body = alternatives[int(random_float() * len(alternatives))]
+		if type(body) is str:
+			return body
+
+		variables = self.variables
+		output = []
+		marks = []
+		stack = [iter(body)]
+		while stack:
+			for opcode, arg in stack[-1]:
+				if opcode == TEXT:
+					output.append(arg)
+				elif opcode == CALL:
+					body = arg[int(random_float() * len(arg))]
+					if type(body) is str:
+						output.append(body)
+						continue
+					stack.append(iter(body))
+					if len(stack) > MAX_EXPANSION_DEPTH:
+						sys.exit("ERROR: The expansion is deeper than {}, the grammar may never end.".format(MAX_EXPANSION_DEPTH))
+					break
+				elif opcode == NAMED:
+					name, rule = arg
+					if name in variables:
+						output.append(variables[name])
+						continue
+					elif rule is None:
+						sys.exit("ERROR: #{}# is neither a variable nor a symbol.".format(name))
+					body = rule[int(random_float() * len(rule))]
+					if type(body) is str:
+						output.append(body)
+						continue
+					stack.append(iter(body))
+					if len(stack) > MAX_EXPANSION_DEPTH:
+						sys.exit("ERROR: The expansion is deeper than {}, the grammar may never end.".format(MAX_EXPANSION_DEPTH))
+					break
+				elif opcode == MARK:
+					marks.append(len(output))
+				elif opcode == SET:
+					start = marks.pop()
+					variables[arg] = "".join(output[start:])
+					del output[start:]
+				else:
+					variables[arg[0]] = arg[1]
+			else:
+				# the rule on top of the stack is done
+				stack.pop()
+		return "".join(output)
+
+
+	def parse_rule(self, value, symbol):
+		"""
+		Parses the String formatted production rule into a body list in one 
+		pass over the string, see RULE_PATTERN
 		
 		ex: "Today, [alien:alienCreature] #alien# showed up in front of #boyName#."
-		This function will be called five times:
-			1st time:
-				-body = ["Today, "]
-				-subtracted string = "[alien:alienCreature] #alien# showed up in front of #boyName#."
-			2nd time:
-				-body = ["Today, ", Set_Variable]
-				-subtracted string = "#alien# showed up in front of #boyName#."
-			3rd time:
-				-body = ["Today, ", Set_Variable, Call_Promise]
-				-subtracted string = "showed up in front of #boyName#."
-			.
-			.
-			.
-			
+			-> ["Today, ", Set_Variable, Call_Promise, " showed up in front of ", Call_Promise, "."]
+
+		Exits with the position of the first # that is never closed, [ that 
+		is not a [key:value], or value that mixes a nonterminal with a string.
+
 		Parameters:
 		value: str
-		body: list
+		symbol: the symbol the rule belongs to, for the errors
 
 		Return:
-		a Parse_Result that includes the subtracted string and the modified body list
+		the body list
 		"""
-		first_char = value[0]
-		i = 0
-		if first_char == '#':
-			symbol_name = ""
-			i += 1 
-			while i < len(value) and value[i] != '#':
-				symbol_name += value[i]
-				i += 1
-			i += 1
-			# set callable
-			new_callable = Call_Promise(symbol_name) #COMMENT THIS OUT FOR VISIBLE
-			# new_callable = "callable: <{}>".format(symbol_name) #VISIBLE
-			body.append(new_callable)
-
-		elif first_char == '[':
-			# only set self.variables
-			token_key = "" 
-			token_value = ""
-			i += 1 
-			while value[i] != ':':
-				token_key += value[i]
-				i += 1 
-			i += 1 # skips :
-			while value[i] != ']':
-				token_value += value[i]
-				i += 1 
-			i += 1 
-
-			# checks if the value is a Callable Object or not
-			if token_value[0] == "#":
-				token_value = token_value[1:len(token_value) - 1]
-				token_value = Call_Promise(token_value) #COMMENT THIS OUT FOR VISIBLE
-				# token_value = "callable: <{}>".format(token_value) #VISIBLE
-
-			new_set_variable = Set_Variable(token_key, token_value) #COMMENT THIS OUT FOR VISIBLE
-			# new_set_variable = "key: <{}> val:<{}>".format(token_key, token_value) #VISIBLE
-			body.append(new_set_variable)
+		body = []
+		for match in RULE_PATTERN.finditer(value):
+			kind = match.lastgroup
+			if kind == "text":
+				body.append(match.group("text"))
 
-		else:
-			string_name = ""
-			while i < len(value) and value[i] != '#' and value[i] != '[':
-				string_name += value[i]
-				i += 1
-			body.append(string_name)
+			elif kind == "call":
+				body.append(Call_Promise(match.group("call")))
+
+			elif kind == "value":
+				# checks if the value is a Callable Object or not
+				token_value = match.group("value")
+				if token_value[:1] == "#":
+					if len(token_value) < 2 or token_value.find("#", 1) != len(token_value) - 1:
+						sys.exit("ERROR: The value at position {} of the rule {!r} of {} ".format(match.start("value"), value, symbol) +\
+						"has to be either a string or one #nonterminal#.")
+					token_value = Call_Promise(token_value[1:-1])
+				body.append(Set_Variable(match.group("key"), token_value))
+
+			elif match.group("error") == "#":
+				sys.exit("ERROR: The # at position {} of the rule {!r} of {} is never closed.".format(match.start(), value, symbol))
 
-		return Parse_Result(body, value[i:])
+			else:
+				sys.exit("ERROR: The [ at position {} of the rule {!r} of {} is not a [key:value].".format(match.start(), value, symbol))
+		return body
 
 
 	def parse_json(self, data):
 		"""
 		Parses the json formatted dictionary into self.grammars_dict: a dictionary whose keys are NonterminalSymbol.
-		This method will use parse_value() as a helper function
+		This method will use parse_rule() as a helper function
 
 		Parameters: 
 		data: the json formatted dictionary
@@ -237,11 +682,7 @@ class Grammar:
 
 			for value in data_value:
 		# create productionRule
-				body = []
-				while not len(value) == 0:
-					parse_result = self.parse_value(value, body)
-					value = parse_result.left_string
-					body = parse_result.body
+				body = self.parse_rule(value, key)
 				new_production_rule = ProductionRule(nonterminal, key, body)
 				# nonterminal.append(body) #VISIBLE
 				nonterminal.add_rule(new_production_rule) #COMMENT THIS OUT FOR VISIBLE
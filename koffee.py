@@ -43,6 +43,7 @@ from dependency_parsing import *
 from markov_run import *
 from building import *
 from eliza import *
+import itertools
 import random
 import spacy
 import time
@@ -74,7 +75,7 @@ def print_text_art():
 
 
 # initialize models
-koffee_grammar = Grammar('./koffee_response/koffee.json')
+koffee_grammar = Grammar('./koffee_response/koffee.json', './grammar_cache')
 dialogtag_model = DialogTag('distilbert-base-uncased')
 SLM_model = train_markov("./texts/markov_text.txt")
 nlp = spacy.load("en_core_web_sm")
@@ -115,18 +116,33 @@ def koffee_print(string):
     '''
     Prints koffee's responses
     '''
+    koffee_print_stream([string])
+
+
+def koffee_print_stream(pieces):
+    '''
+    Prints koffee's responses from pieces of text as they come, e.g. a markov quote 
+    that is still being generated, breaking lines the same way as koffee_print
+    '''
     time.sleep(0.5)
-    string_list = string.split(" ")
     charCount = 0
+    word = ""
 
-    print("Koffee:", end=" ")
-    for i in range(len(string_list)):
-        if charCount > 70: # breaks line ~ every 70 characters
-            print("\n" + (" "*8), end="")
-            charCount = 0
-            
-        print(string_list[i], end=" ")
-        charCount += len(string_list[i])
+    print("Koffee:", end=" ", flush=True)
+    for piece in itertools.chain(pieces, [None]):
+        if piece is None: # prints the last word once all the pieces are in
+            string_list = [word]
+        else:
+            string_list = (word + piece).split(" ")
+            word = string_list.pop()
+
+        for i in range(len(string_list)):
+            if charCount > 70: # breaks line ~ every 70 characters
+                print("\n" + (" "*8), end="")
+                charCount = 0
+
+            print(string_list[i], end=" ", flush=True)
+            charCount += len(string_list[i])
     print()
     time.sleep(0.5)
 
@@ -243,12 +259,12 @@ def initialize_buiildings():
     Initializes Building classes for all the buildings and returns them in form of a dictionary.
     """
     return {
-        "libe": Building('./building_grammars/libe.json', "libe"),
-        "olin": Building('./building_grammars/olin.json', "olin"),
-        "weitz": Building('./building_grammars/weitz.json', "weitz"),
-        "cmc": Building('./building_grammars/cmc.json', "cmc"),
-        "anderson": Building('./building_grammars/anderson.json', "anderson"),
-        "sayles": Building('./building_grammars/sayles.json', "sayles")
+        "libe": Building('./building_grammars/libe.json', "libe", './grammar_cache'),
+        "olin": Building('./building_grammars/olin.json', "olin", './grammar_cache'),
+        "weitz": Building('./building_grammars/weitz.json', "weitz", './grammar_cache'),
+        "cmc": Building('./building_grammars/cmc.json', "cmc", './grammar_cache'),
+        "anderson": Building('./building_grammars/anderson.json', "anderson", './grammar_cache'),
+        "sayles": Building('./building_grammars/sayles.json', "sayles", './grammar_cache')
     }
 
 
@@ -415,8 +431,10 @@ def small_talk():
 
     # talk about a markov_generated quote ~ every three small talks
     if random.choice([1,2,3]) == 1:
-        s = "Do you know that the president said \"" + (SLM_model.generate(50)) + "\" I thought that was cool."
-        koffee_print(s)
+        # steers the quote towards the user's major when the president talked about it
+        prompt = major.lower() if major not in ["", "other"] else "\n"
+        quote = SLM_model.generate_iter(50, prompt, sentence=True)
+        koffee_print_stream(itertools.chain(["Do you know that the president said \""], quote, ["\" I thought that was cool."]))
 
     # removes question from small_talk_questions
     for tup in small_talk_questions:
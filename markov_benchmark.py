@@ -0,0 +1,336 @@
+'''
+markov_benchmark.py
+
+Benchmarks for the statistical language model in markov_run.py.
+Run with `python3 markov_benchmark.py` from the root of the repo, see
+`python3 markov_benchmark.py --help` for the corpora, levels and orders
+to run. The results are printed and written to a json file so that runs 
+can be compared.
+
+@author: Yuting, PJ, and Minh
+'''
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from markov_run import NgramTrie, SLM
+
+SOURCE_CORPUS = "./texts/markov_text.txt"
+DEFAULT_OUTPUT = "markov_benchmark_results.json"
+
+
+def synthetic_corpus(source, scale, seed=0):
+	"""
+	Writes a synthetic corpus that is `scale` times the size of source by
+	shuffling its lines with a seeded random generator.
+
+	Parameters:
+		source: the path to the corpus to scale up
+		scale: how many copies of the source lines to write
+		seed (optional): the seed for the shuffling
+
+	Returns:
+		path: the path to the temporary file holding the synthetic corpus
+	"""
+	with open(source, "r") as file:
+		lines = file.readlines()
+
+	rng = random.Random(seed)
+	fd, path = tempfile.mkstemp(prefix="synthetic_{}x_".format(scale), suffix=".txt")
+	with os.fdopen(fd, "w") as out:
+		for i in range(scale):
+			rng.shuffle(lines)
+			out.writelines(lines)
+	return path
+
+
+def time_training(path, level, order, repeat=3, dense=False):
+	"""
+	Times SLM.populate_transitions_from_lst, or SLM.populate_dense_from_lst 
+	with dense, on the given corpus.
+	Tokenization is done once beforehand so only the counting is measured.
+
+	Returns:
+		(best_seconds, number_of_tokens)
+	"""
+	tokens = list(SLM(path, level, order).tokenize_file())
+
+	best = float("inf")
+	for i in range(repeat):
+		slm = SLM(path, level, order)
+		lst = list(tokens)
+		start = time.perf_counter()
+		if dense:
+			slm.populate_dense_from_lst(lst, 100)
+		else:
+			slm.populate_transitions_from_lst(lst, 100)
+		best = min(best, time.perf_counter() - start)
+	return best, len(tokens)
+
+
+def measure_memory(path, level, order):
+	"""
+	Measures the memory footprint of an SLM trained on the given corpus:
+	the memory taken by the dict model while counting, with tracemalloc, 
+	and the size of its compact arrays (see SLM.compact).
+	Tokenization is done before tracing so only the model is measured.
+
+	Returns:
+		(peak_training_bytes, model_bytes, packed_bytes)
+	"""
+	slm = SLM(path, level, order)
+	tokens = list(slm.tokenize_file())
+	tracemalloc.start()
+	try:
+		slm.populate_transitions_from_lst(tokens, 100)
+		model_bytes, peak_bytes = tracemalloc.get_traced_memory()
+	finally:
+		tracemalloc.stop()
+	return peak_bytes, model_bytes, slm.get_packed().nbytes()
+
+
+def time_multi_order_training(path, level, max_order):
+	"""
+	Times training every order from 1 to max_order, once as one NgramTrie and
+	once as one SLM per order.
+
+	Returns:
+		(trie_seconds, slm_seconds)
+	"""
+	start = time.perf_counter()
+	NgramTrie(path, level, max_order).train()
+	trie_seconds = time.perf_counter() - start
+
+	start = time.perf_counter()
+	for order in range(1, max_order + 1):
+		SLM(path, level, order).train()
+	return trie_seconds, time.perf_counter() - start
+
+
+def time_tokenization(path, level, repeat=3):
+	"""
+	Times SLM.tokenize_file on the given corpus.
+
+	Returns:
+		tokens_per_second: tokens produced per second
+	"""
+	slm = SLM(path, level, 1)
+	best = float("inf")
+	for i in range(repeat):
+		start = time.perf_counter()
+		tokens = sum(1 for token in slm.tokenize_file())
+		best = min(best, time.perf_counter() - start)
+	return tokens / best
+
+
+def time_generation(slm, length=50, samples=2000):
+	"""
+	Times SLM.generate on a trained model.
+
+	Returns:
+		tokens_per_second: generated tokens per second, counting failed samples
+	"""
+	start = time.perf_counter()
+	for i in range(samples):
+		slm.generate(length)
+	return samples * length / (time.perf_counter() - start)
+
+
+def time_batch_generation(slm, length=50, samples=2000):
+	"""
+	Times SLM.generate_batch on a trained model.
+
+	Returns:
+		tokens_per_second: generated tokens per second, counting failed samples
+	"""
+	start = time.perf_counter()
+	slm.generate_batch(samples, length, seed=0)
+	return samples * length / (time.perf_counter() - start)
+
+
+def time_scoring(slm, repeat=3):
+	"""
+	Times SLM.get_likelihood over the whole tokenized corpus of a trained model.
+
+	Returns:
+		tokens_per_second: scored tokens per second
+	"""
+	best = float("inf")
+	for i in range(repeat):
+		start = time.perf_counter()
+		slm.get_likelihood(slm.tokenized_list)
+		best = min(best, time.perf_counter() - start)
+	return len(slm.tokenized_list) / best
+
+
+def environment():
+	"""
+	Returns a dict describing where the benchmarks ran, to tell runs apart
+	"""
+	try:
+		commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, 
+								text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		commit = None
+	return {
+		"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"commit": commit,
+		"python": platform.python_version(),
+		"numpy": np.__version__,
+		"platform": platform.platform(),
+		"processor": platform.processor(),
+	}
+
+
+def benchmark_model(name, path, level, order, repeat=3):
+	"""
+	Runs every benchmark of one SLM configuration on the given corpus
+	and prints them.
+
+	Parameters:
+		name: the name of the corpus in the results
+		path: the path to the corpus
+		level: "word" or "character"
+		order: the order of the model
+		repeat (optional): how many times to repeat the timings, keeping the best
+
+	Returns:
+		result: a dict of the measurements
+	"""
+	seconds, tokens = time_training(path, level, order, repeat)
+	peak_bytes, model_bytes, packed_bytes = measure_memory(path, level, order)
+
+	slm = SLM(path, level, order)
+	slm.train(80, 500)
+	result = {
+		"corpus": name,
+		"level": level,
+		"order": order,
+		"tokens": tokens,
+		"training_seconds": seconds,
+		"training_tokens_per_second": tokens / seconds,
+		"peak_training_bytes": peak_bytes,
+		"model_bytes": model_bytes,
+		"packed_bytes": packed_bytes,
+		"scoring_tokens_per_second": time_scoring(slm, repeat),
+		"generation_tokens_per_second": time_generation(slm),
+		"batch_generation_tokens_per_second": time_batch_generation(slm),
+	}
+	print("{corpus} {level} order {order}: trained {tokens} tokens in {training_seconds:.3f}s, "
+		"{model_bytes:,} bytes as dicts (peak {peak_training_bytes:,}), {packed_bytes:,} bytes packed, "
+		"scoring {scoring_tokens_per_second:,.0f} tokens/s, generation {generation_tokens_per_second:,.0f} tokens/s, "
+		"batched {batch_generation_tokens_per_second:,.0f} tokens/s".format(**result))
+	return result
+
+
+def run_suite(scales, levels, orders, repeat=3, seed=0):
+	"""
+	Runs the benchmarks on the source corpus and on a synthetic corpus per
+	scale, for every level and order, then compares dense against packed 
+	training and one NgramTrie against one SLM per order on the biggest corpus.
+
+	Parameters:
+		scales: the sizes of the synthetic corpora, in copies of the source corpus
+		levels: the levels of the models
+		orders: the orders of the models
+		repeat (optional): how many times to repeat the timings, keeping the best
+		seed (optional): the seed of the synthetic corpora and of the generation
+
+	Returns:
+		results: a json serializable dict of every measurement
+	"""
+	results = {
+		"environment": environment(),
+		"parameters": {"scales": scales, "levels": levels, "orders": orders, 
+			"repeat": repeat, "seed": seed},
+		"corpora": [],
+		"tokenization": [],
+		"models": [],
+		"dense": [],
+		"multi_order": [],
+	}
+
+	corpora = [("markov_text", SOURCE_CORPUS)]
+	try:
+		for scale in scales:
+			corpora.append(("synthetic_{}x".format(scale), synthetic_corpus(SOURCE_CORPUS, scale, seed)))
+		for name, path in corpora:
+			results["corpora"].append({"corpus": name, "bytes": os.path.getsize(path)})
+
+		print("\n----Tokenization Speed----\n")
+		for name, path in corpora:
+			for level in levels:
+				rate = time_tokenization(path, level, repeat)
+				results["tokenization"].append({"corpus": name, "level": level, "tokens_per_second": rate})
+				print("{name} {level}: {rate:,.0f} tokens/s".format(name=name, level=level, rate=rate))
+
+		print("\n----Models----\n")
+		for name, path in corpora:
+			for level in levels:
+				for order in orders:
+					random.seed(seed)
+					results["models"].append(benchmark_model(name, path, level, order, repeat))
+
+		name, path = corpora[-1]
+		print("\n----Dense Training----\n")
+		if "character" in levels:
+			for order in orders:
+				packed_seconds, tokens = time_training(path, "character", order, repeat)
+				try:
+					dense_seconds, tokens = time_training(path, "character", order, repeat, dense=True)
+				except SystemExit as error:
+					# the dense matrix of the order does not fit, see check_dense_size
+					print("{name} character order {order}: {error}".format(name=name, order=order, error=error))
+					continue
+				results["dense"].append({"corpus": name, "order": order, "tokens": tokens,
+					"packed_seconds": packed_seconds, "dense_seconds": dense_seconds})
+				print("{name} character order {order}: packed {packed:.3f}s, dense {dense:.3f}s".format(
+					name=name, order=order, packed=packed_seconds, dense=dense_seconds))
+
+		print("\n----Multi Order Training----\n")
+		for level in levels:
+			trie_seconds, slm_seconds = time_multi_order_training(path, level, max(orders))
+			results["multi_order"].append({"corpus": name, "level": level, "max_order": max(orders),
+				"trie_seconds": trie_seconds, "slm_seconds": slm_seconds})
+			print("{name} {level} orders 1-{order}: one NgramTrie {trie:.3f}s, one SLM per order {slm:.3f}s".format(
+				name=name, level=level, order=max(orders), trie=trie_seconds, slm=slm_seconds))
+	finally:
+		for name, path in corpora[1:]:
+			os.remove(path)
+	return results
+
+
+def main(argv=None):
+	"""
+	Runs the benchmark suite with the command line arguments and writes 
+	the results to a json file. By default the synthetic corpora are 10x 
+	and 100x the source corpus; 1000x has to be asked for with --scales as
+	tokenizing it at the character level takes several GB of memory.
+	"""
+	parser = argparse.ArgumentParser(description="Benchmarks the SLM of markov_run.py")
+	parser.add_argument("--scales", type=int, nargs="*", default=[10, 100],
+		help="the sizes of the synthetic corpora, in copies of the source corpus (e.g. 10 100 1000)")
+	parser.add_argument("--levels", nargs="+", default=["word", "character"], choices=["word", "character"])
+	parser.add_argument("--orders", type=int, nargs="+", default=[2, 3, 4, 5])
+	parser.add_argument("--repeat", type=int, default=3, help="how many times to repeat the timings, keeping the best")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--output", default=DEFAULT_OUTPUT, help="the json file to write the results to")
+	args = parser.parse_args(argv)
+
+	results = run_suite(args.scales, args.levels, args.orders, args.repeat, args.seed)
+	with open(args.output, "w") as file:
+		json.dump(results, file, indent=2)
+	print("\nResults written to {}".format(args.output))
+
+
+if __name__ == "__main__":
+	main()
@@ -8,10 +8,48 @@ to generate new sentences based on data of quotes
 @date: 05/14/2021
 '''
 
+import array
+import bisect
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
+import os
 import random
 import re
 import sys
 import statistics
+import struct
+import tempfile
+import zlib
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# on-disk model cache: magic, format version, then a length-prefixed json header
+CACHE_MAGIC = b"SLMC"
+CACHE_VERSION = 2
+CACHE_ALIGNMENT = 8
+# where SLM.publish writes models for other processes to map
+SHARED_MEMORY_DIR = "/dev/shm"
+
+# DenseTransitions: the largest direct context index and the largest matrix, in cells
+DENSE_INDEX_LIMIT = 1 << 22
+DENSE_CELL_LIMIT = 1 << 23
+
+# an escape like \t, a run of letters and digits, or any single character but a space
+WORD_TOKEN_PATTERN = re.compile(r"\\.|[^\W_]+|[^ ]", re.DOTALL)
+# an escape like \t or any single character but a space
+CHARACTER_TOKEN_PATTERN = re.compile(r"\\.|[^ ]", re.DOTALL)
+# whitespace that comes before a symbol
+WHITE_SPACE_ON_SYMBOL_PATTERN = re.compile(r"\s+(?=[\W])")
+WORD_CHARACTER_PATTERN = re.compile(r"\w")
+# tokens that end a sentence, see SLM.generate_sentence
+SENTENCE_END_TOKENS = frozenset([".", "!", "?", "\n"])
+# token without whitespace -> whether it starts with a word character, filled by TextStream.clean
+TOKEN_KINDS = {}
 
 class SLM:
 	"""
@@ -44,6 +82,20 @@ class SLM:
 		# will contain either tokenized chars or words in order of appearance in the text
 		self.tokenized_list = [];
 		self.transitions = {}
+		# ngram tuple -> {tuple of following tokens: count}, the raw counts behind transitions
+		self.counts = {}
+		# ngram tuple -> (list of followers, cumulative upper bounds), built lazily by find_next
+		self.samplers = {}
+		# PackedTransitions replacing the dicts above once the model is compact, see compact()
+		self.packed = None
+		# PackedTransitions packed from the dicts for scoring while the model is not compact
+		self.scoring_table = None
+		# ngram tuples whose counts changed after their transitions were built, see update()
+		self.dirty = set()
+		# ngram tuples whose counts changed after scoring_table was packed, see update()
+		self.stale = set()
+		# the random.Random that generation draws from, the random module's when None, see seed()
+		self.random = None
 		self.mean = -1
 		self.standard_deviation = -1
 
@@ -59,376 +111,2915 @@ class SLM:
 		Returns:
 			lst: the list of tokens
 		"""
-		lst = []
-
-		string = string.lower()
-		string_length = len(string) 
-		token = ""
-
-		for i in range(string_length):
-			# append \[smth] operation to the lst and skip one index
-			if string[i] == "\\":
-				lst.append(string[i] + string[i + 1]) # for \t, \n, etc.
-				i+=1
-			# append token to lst and reset token
-			elif string[i] == " ": 
-				# token will be "" when the previous index is a symbol
-				if token != "": 
-					lst.append(token) 
-					token = ""
-			# append token to lst, append symbol to lst, and reset token
-			elif not string[i].isalpha() and not string[i].isdigit():
-				if token != "": 
-					lst.append(token) 
-					token = ""
-				lst.append(string[i]) # append symbol
-			# construct token with current character
+		return WORD_TOKEN_PATTERN.findall(string.lower())
+
+
+	def split_with_character(self, string):
+		"""
+		Takes in a string and splits it into tokens by characters. 
+		Tabs, newlines, and punctuations count as tokens
+		
+		Parameters:
+			string: the string to be tokenized
+			
+		Returns:
+			lst: the list of tokens
+		"""
+		return CHARACTER_TOKEN_PATTERN.findall(string.lower())
+
+
+	def tokenize_file(self, block_size=1 << 16):
+		"""
+		Tokenizes self.corpus based on self.level, reading it in blocks of 
+		block_size characters so the whole corpus is never held in memory. 
+		A token that may continue past the end of a block is carried over to 
+		the next one.
+
+		Parameters:
+			block_size (optional): the number of characters read at a time
+
+		Yields:
+			the tokens of the corpus in order of appearance
+		"""
+		if self.level == "word":
+			pattern = WORD_TOKEN_PATTERN
+		elif self.level == "character":
+			pattern = CHARACTER_TOKEN_PATTERN
+		else:
+			sys.exit("ERROR: Invalid level parameter: " + self.level + \
+				"\nlevel should either be \"word\" or \"character\"")
+
+		carry = ""
+		with open(self.corpus, "r") as file:
+			for block in iter(lambda: file.read(block_size), ""):
+				tokens = pattern.findall(carry + block.lower())
+				# every character but a space is part of a token, so unless the block ends 
+				# with a space its last token (a word or an escape) might go on in the next block
+				carry = tokens.pop() if tokens and not block.endswith(" ") else ""
+				yield from tokens
+		if carry:
+			yield carry
+
+		
+	def count_transitions(self, tokens):
+		"""
+		Helper function for training.
+		Counts, in one pass, which tokens follow every ngram of an iterable of
+		tokens that is ordered based on their appearance in the corpus.
+
+		Parameters:
+			tokens: an iterable of tokens
+
+		Returns:
+			counts: a dict of ngram tuple -> {tuple of following tokens: count}
+		"""
+		tokens = iter(tokens)
+		ngram = tuple(itertools.islice(tokens, self.order))
+		if len(ngram) < self.order:
+			sys.exit("ERROR: The corpus is smaller than the order." +\
+			"\nLower the order or change to a bigger corpus")
+
+		# counts[ngram][following_tokens] -> number of times seen
+		counts = defaultdict(Counter)
+		start_key = ("\n",)
+		for word in tokens:
+			# Special case for new lines
+			if ngram[0] == "\n":
+				counts[start_key][ngram[1:] + (word,)] += 1
+
+			# Normal cases
+			counts[ngram][(word,)] += 1
+			ngram = ngram[1:] + (word,)
+
+		return dict(counts)
+
+
+	def populate_transitions_from_lst(self, lst, p):
+		"""
+		Helper function for train.
+		Populates self.transitions dictionary from a lst of strings that is 
+		ordered based on their appearance in the corpus.
+		
+		Parameters:
+			lst: a list of tokens
+			p: a number between 0 and 100, the percentage of the lst to be trained on from the beginning
+		"""
+		if len(lst) < self.order:
+			sys.exit("ERROR: The corpus is smaller than the order." +\
+			"\nLower the order or change to a bigger corpus")
+		
+		# to ensure that there is at least one \n in the lst
+		lst.insert(0, "\n") 
+
+		train_till = int(len(lst)/100*p)
+		self.counts = self.count_transitions(itertools.islice(lst, train_till))
+		self.populate_transitions_from_counts(self.counts)
+
+
+	def populate_dense_from_lst(self, lst, p):
+		"""
+		Helper function for train.
+		Same as populate_transitions_from_lst, but counts the transitions into
+		a DenseTransitions with array operations (see count_dense_transitions)
+		and leaves the model dense instead of filling self.transitions
+		
+		Parameters:
+			lst: a list of tokens
+			p: a number between 0 and 100, the percentage of the lst to be trained on from the beginning
+		"""
+		if len(lst) < self.order:
+			sys.exit("ERROR: The corpus is smaller than the order." +\
+			"\nLower the order or change to a bigger corpus")
+		
+		# to ensure that there is at least one \n in the lst
+		lst.insert(0, "\n") 
+
+		train_till = int(len(lst)/100*p)
+		self.packed = count_dense_transitions(lst[:train_till], self.order)
+		self.scoring_table = None
+		self.counts = {}
+		self.transitions = {}
+		self.samplers = {}
+		self.dirty = set()
+
+
+	def populate_transitions_from_counts(self, counts):
+		"""
+		Helper function for populate_transitions_from_lst.
+		Turns the follower counts of every ngram into the (lo, hi) probability 
+		bounds stored in self.transitions.
+
+		Parameters:
+			counts: a dict of ngram tuple -> {tuple of following tokens: count}
+		"""
+		self.samplers = {}
+		self.packed = None
+		self.scoring_table = None
+		self.dirty = set()
+		for key, followers in counts.items():
+			self.transitions[key] = self.transition_bounds(followers)
+
+
+	def transition_bounds(self, followers):
+		"""
+		Helper function for populate_transitions_from_counts.
+		Returns the value of self.transitions for an ngram from its follower counts
+		"""
+		value = [] # value in transitions, to be filled
+		total = sum(followers.values())
+		lo = 0.0
+		for words, count in followers.items():
+			hi = lo + count/total
+			value.append((list(words), (lo, hi)))
+			lo = hi
+		# value should be filled by now
+		return value
+
+
+	def update(self, text):
+		"""
+		Adds the tokens of text to the trained model without retraining, as if 
+		text was one more line at the end of the corpus. Only the counts are 
+		updated right away, the contexts they belong to are marked dirty and 
+		their transitions are renormalized the next time they are sampled 
+		(see get_sampler). The packed table used for scoring is kept, and 
+		only the changed contexts are scored from self.counts (see score_tokens)
+		until they are a quarter of its contexts and it is packed again.
+		A compact model is expanded first (see expand()), which rebuilds the
+		dicts of the whole model on its first update.
+		The z score estimator is not recalibrated, and a pruned model may get 
+		dead ends back (see prune_dead_ends()).
+
+		Parameters:
+			text: the string to learn from
+
+		Returns:
+			updated: the number of ngrams whose followers changed
+		"""
+		if self.level == "word":
+			tokens = self.split_with_word(text)
+
+		elif self.level == "character":
+			tokens = self.split_with_character(text)
+
+		else:
+			sys.exit("ERROR: Invalid level parameter: " + self.level + \
+				"\nlevel should either be \"word\" or \"character\"")
+
+		# the \n in front starts a new line like in the corpus, see populate_transitions_from_lst
+		tokens.insert(0, "\n")
+		if len(tokens) <= self.order:
+			return 0
+
+		self.expand()
+		new_counts = self.count_transitions(tokens)
+		for key, followers in new_counts.items():
+			counts = self.counts.setdefault(key, {})
+			for words, count in followers.items():
+				counts[words] = counts.get(words, 0) + count
+			self.samplers.pop(key, None)
+			self.dirty.add(key)
+		if self.scoring_table:
+			self.stale.update(new_counts)
+			if 4 * len(self.stale) > len(self.scoring_table.context_keys):
+				self.scoring_table = None
+		return len(new_counts)
+
+
+	def train(self, p=100, chunck_size=1000, cache_dir=None, prune=False, dense=False):
+		"""
+		Trains a model given the percentage to train.
+		The chunk size can be provided to create a z_score_estimator out of this.
+		With prune, the transitions that lead into dead ends are removed after 
+		counting, see prune_dead_ends(). With dense, the transitions are counted
+		straight into a DenseTransitions (see densify()), meant for character 
+		level models
+
+		If a cache_dir is given, a model trained earlier with the same corpus content,
+		level, order, p and chunck_size is loaded from it instead of retraining, and
+		newly trained models are saved there for the next start. A cache file that
+		can't be loaded is retrained and written again. A model loaded from the 
+		cache is not tokenized: its tokenized_list stays empty. The cache holds
+		packed arrays, models whose contexts can't be packed (see 
+		get_scoring_table) are not cached.
+
+		Parameters:
+			p (optional): a number between 0 and 100 representing how much of 
+						  the corpus should be trained from the beginning
+			chunck_size (optional): the chunk size for the z score estimator
+			cache_dir (optional): the directory holding cached models
+			prune (optional): whether to prune the dead ends for generation
+			dense (optional): whether to train into dense transitions
+		"""
+		cache_path = None
+		if cache_dir is not None:
+			cache_path = self.cache_path(cache_dir, p, chunck_size, prune)
+			if os.path.exists(cache_path) and self.load(cache_path):
+				if dense:
+					self.densify()
+				return
+
+		# if token_list is empty, calculate and record the tokenized_list
+		if not self.tokenized_list:
+			self.tokenized_list = list(self.tokenize_file())
+
+		if dense:
+			self.populate_dense_from_lst(self.tokenized_list, p)
+		else:
+			self.populate_transitions_from_lst(self.tokenized_list, p)
+
+		if prune:
+			self.prune_dead_ends()
+			if dense:
+				self.densify()
+
+		if p < 100:
+			self.z_score_estimator(chunck_size, 100 - p)
+
+		if cache_path is not None and self.get_scoring_table() is not None:
+			os.makedirs(cache_dir, exist_ok=True)
+			self.save(cache_path)
+
+
+	def train_stream(self, block_size=1 << 16):
+		"""
+		Trains a model on the whole corpus straight from tokenize_file(), without
+		recording self.tokenized_list, so memory stays bounded by the size of 
+		the model rather than the size of the corpus.
+		Equivalent to train() with p = 100
+
+		Parameters:
+			block_size (optional): the number of characters read at a time
+		"""
+		# the \n train() inserts in front of the tokenized_list
+		tokens = itertools.chain(["\n"], self.tokenize_file(block_size))
+		self.counts = self.count_transitions(tokens)
+		self.populate_transitions_from_counts(self.counts)
+
+
+	def train_out_of_core(self, p=100, chunck_size=1000, spill_dir=None, batch_tokens=1 << 22, block_size=1 << 16):
+		"""
+		Trains a model on a corpus that may be larger than memory. The tokens
+		are streamed from tokenize_file() and counted batch_tokens at a time; 
+		every batch is written to disk as a sorted run of ngram counts (see 
+		spill_ngram_run), and the runs are merged into the model's 
+		PackedTransitions (see merge_ngram_runs), so the model is compact after
+		training. Memory is bounded by the batch, the vocabulary and the 
+		model itself, never the corpus. Gives the same model as train(p, chunck_size)
+
+		Parameters:
+			p (optional): a number between 0 and 100 representing how much of 
+						  the corpus should be trained from the beginning
+			chunck_size (optional): the chunk size for the z score estimator
+			spill_dir (optional): the directory for the temporary runs, the system's by default
+			batch_tokens (optional): the number of tokens counted in memory at a time
+			block_size (optional): the number of characters read at a time
+		"""
+		# the \n train() inserts in front of the tokenized_list
+		length = None
+		train_till = None
+		if p < 100:
+			length = 1 + sum(1 for token in self.tokenize_file(block_size))
+			train_till = int(length/100*p)
+		tokens = itertools.islice(itertools.chain(["\n"], self.tokenize_file(block_size)), train_till)
+
+		vocab = {}
+		overlap = []
+		with tempfile.TemporaryDirectory(dir=spill_dir) as directory:
+			paths = []
+			while True:
+				batch = list(itertools.islice(tokens, batch_tokens))
+				if not batch:
+					break
+				ids = overlap + [vocab.setdefault(token, len(vocab)) for token in batch]
+				if len(ids) > self.order:
+					paths.append(os.path.join(directory, "run{}.npy".format(len(paths))))
+					spill_ngram_run(np.array(ids, dtype=np.int64), self.order, paths[-1])
+				# the windows that cross into the next batch start from the last `order` tokens
+				overlap = ids[-self.order:]
+
+			if not paths and len(overlap) < self.order:
+				sys.exit("ERROR: The corpus is smaller than the order." +\
+				"\nLower the order or change to a bigger corpus")
+			packed = merge_ngram_runs(paths, sorted(vocab, key=vocab.get), self.order)
+
+		self.tokenized_list = []
+		self.counts = {}
+		self.transitions = {}
+		self.samplers = {}
+		self.dirty = set()
+		self.scoring_table = None
+		self.packed = packed
+
+		if p < 100:
+			tokens = itertools.chain(["\n"], self.tokenize_file(block_size))
+			self.stream_z_score_estimator(tokens, length, chunck_size, 100 - p)
+
+
+	def stream_z_score_estimator(self, tokens, length, chunk_size, test_size):
+		"""
+		Same as z_score_estimator, but reads the test portion from an iterator 
+		of tokens one chunk at a time instead of from self.tokenized_list
+
+		Parameters:
+			tokens: an iterator over the whole tokenized corpus, with the "\n" train() puts in front
+			length: the number of tokens in it
+			chunk_size: the numbers of words in each chunk
+			test_size: the size of the test portion (out of a 100)
+		"""
+		start = int(length * (100 - test_size) / 100) 
+		if (start + self.order > length):
+			sys.exit("ERROR: The text to be estimated is too small")
+
+		packed = self.get_packed()
+		tokens = itertools.islice(tokens, start, None)
+		chunk_raw_scores = []
+		for chunk_start, chunk_end in chunk_bounds(start, length, chunk_size):
+			chunk = list(itertools.islice(tokens, chunk_end - chunk_start))
+			# normalizes the likelihood by dividing with the size
+			chunk_raw_scores.append(float(packed.score_ids(packed.encode(chunk)).sum()) / len(chunk))
+
+		# cal sd and mean
+		self.mean = sum(chunk_raw_scores) / len(chunk_raw_scores)
+		self.standard_deviation = statistics.stdev(chunk_raw_scores)
+
+
+	def prune_dead_ends(self):
+		"""
+		Removes the transitions that lead into dead ends, so that generation
+		never runs into a context that is not in the transitions and can always
+		reach the end of a sentence (a token in SENTENCE_END_TOKENS).
+		Only the contexts returned by live_contexts are kept, and only their 
+		followers that lead to another live context. The counts of the kept 
+		followers are unchanged, so they are renormalized among themselves.
+		A compact model stays compact.
+
+		Returns:
+			removed: the number of followers that were removed
+		"""
+		compact = self.packed is not None
+		counts = self.packed.to_counts() if compact else self.counts
+		live = live_contexts(counts, self.order)
+
+		pruned = {}
+		for key, followers in counts.items():
+			# the followers of the start are whole contexts, see count_transitions
+			if key == ("\n",) and self.order > 1:
+				kept = {words: count for words, count in followers.items() if words in live}
+			elif key in live:
+				kept = {words: count for words, count in followers.items() if key[1:] + words in live}
 			else:
-				token += string[i]
-					
-		return lst
+				continue
+			if kept:
+				pruned[key] = kept
+
+		self.counts = pruned
+		self.transitions = {}
+		self.populate_transitions_from_counts(pruned)
+		if compact:
+			self.compact()
+		return sum(map(len, counts.values())) - sum(map(len, pruned.values()))
+
+
+	def prune(self, min_count=1, max_bytes=None, heldout=None):
+		"""
+		Makes the model smaller by removing rare and low-information followers.
+
+		First every follower seen fewer than min_count times is removed. Then,
+		if max_bytes is given, followers are removed in the order of the 
+		information the model loses with them until the packed arrays and the
+		vocabulary of the tokens left (see PackedTransitions.nbytes and 
+		vocab_nbytes) fit in max_bytes. A follower w of a context c
+		costs P(c) * -log(1 - P(w | c)), the relative entropy between the model
+		before and after w is removed and the other followers of c are 
+		renormalized (Stolcke's entropy pruning), with P(w | c) smoothed as
+		count / (count(c) + 1) so that the last follower of a context has a 
+		finite cost. Contexts left without followers are removed. The followers
+		of the start ("\n",) are only pruned by min_count.
+		A compact model stays compact. The z score estimator is not recalibrated,
+		and the pruned model may have dead ends (see prune_dead_ends()). A 
+		max_bytes is measured on the packed arrays, so it needs a model whose
+		contexts can be packed (see get_scoring_table).
+
+		Parameters:
+			min_count (optional): the smallest count a follower needs to be kept
+			max_bytes (optional): the size the packed arrays and the vocabulary should fit in
+			heldout (optional): a list of tokens to report the likelihood of
+
+		Returns:
+			report: a dict with the number of contexts, followers and bytes (packed
+					arrays and vocabulary, None if the model can't be packed) before
+					and after pruning, and the likelihood of heldout if given
+		"""
+		compact = self.packed is not None
+		counts = self.packed.to_counts() if compact else self.counts
+		report = {
+			"contexts_before": len(counts),
+			"followers_before": sum(map(len, counts.values())),
+			"bytes_before": self.packed_nbytes()
+		}
+		if heldout is not None:
+			report["heldout_likelihood_before"] = self.get_likelihood(heldout)
+
+		pruned = {}
+		for key, followers in counts.items():
+			kept = {words: count for words, count in followers.items() if count >= min_count}
+			if kept:
+				pruned[key] = kept
+
+		if max_bytes is not None:
+			pruned = self.prune_to_budget(pruned, max_bytes)
+
+		self.counts = pruned
+		self.transitions = {}
+		self.populate_transitions_from_counts(pruned)
+		if compact:
+			self.compact()
+
+		report["contexts_after"] = len(pruned)
+		report["followers_after"] = sum(map(len, pruned.values()))
+		report["bytes_after"] = self.packed_nbytes()
+		if heldout is not None:
+			report["heldout_likelihood_after"] = self.get_likelihood(heldout)
+		return report
+
+
+	def packed_nbytes(self):
+		"""
+		Helper function for prune()
+		Returns the bytes of the packed arrays and the vocabulary of the model, 
+		None if its contexts can't be packed (see get_scoring_table)
+		"""
+		packed = self.get_scoring_table(fresh=True)
+		if packed is None:
+			return None
+		return packed.nbytes() + packed.vocab_nbytes()
+
+
+	def prune_to_budget(self, counts, max_bytes):
+		"""
+		Helper function for prune()
+		Returns counts without the followers of lowest cost (see prune()) 
+		whose removal brings the packed arrays and the vocabulary down to max_bytes
+		"""
+		start_key = ("\n",) if self.order > 1 else None
+		keys = [key for key in counts if key != start_key]
+		if not keys:
+			return counts
+		sizes = np.array([len(counts[key]) for key in keys])
+		rows = np.repeat(np.arange(len(keys)), sizes)
+		follower_counts = np.fromiter((count for key in keys for count in counts[key].values()), 
+			dtype=np.float64, count=len(rows))
+		context_counts = np.bincount(rows, weights=follower_counts)
+
+		# P(c) * -log(1 - P(w | c)) with P(w | c) = count / (count(c) + 1)
+		costs = context_counts[rows] / context_counts.sum() * \
+			np.log1p(follower_counts / (context_counts[rows] + 1 - follower_counts))
+		# ties are broken by the tokens of the context and then of the follower, not by
+		# the order of counts, so a model prunes the same whether it is compact or not
+		key_ranks = np.empty(len(keys), dtype=np.int64)
+		key_ranks[sorted(range(len(keys)), key=keys.__getitem__)] = np.arange(len(keys))
+		follower_ranks = {words: rank for rank, words in 
+			enumerate(sorted({words for key in keys for words in counts[key]}))}
+		word_ranks = np.fromiter((follower_ranks[words] for key in keys for words in counts[key]), 
+			dtype=np.int64, count=len(rows))
+		order = np.lexsort((word_ranks, key_ranks[rows], costs))
+
+		# bytes saved by removing the followers in that order: next_ids and cumulative 
+		# per follower, plus context_keys and offsets when the last one of a context goes
+		saved = np.full(len(order), 12)
+		step = np.empty(len(order), dtype=np.int64)
+		step[order] = np.arange(len(order))
+		last = np.zeros(len(keys), dtype=np.int64)
+		np.maximum.at(last, rows, step)
+		saved[last] += 16
+
+		# plus a token of the vocabulary when the last context or follower it is in goes,
+		# the tokens of the start followers are never removed
+		removed_at = {}
+		never = len(order)
+		if start_key in counts:
+			for words in counts[start_key]:
+				for token in words:
+					removed_at[token] = never
+		for row, key in enumerate(keys):
+			for token in key:
+				removed_at[token] = max(removed_at.get(token, -1), int(last[row]))
+		edge_steps = step.tolist()
+		edge = 0
+		for key in keys:
+			for words in counts[key]:
+				removed_at[words[0]] = max(removed_at.get(words[0], -1), edge_steps[edge])
+				edge += 1
+		for token, at in removed_at.items():
+			if at < never:
+				# the string, its slot in the vocab list and its token_ids entry
+				saved[at] += sys.getsizeof(token) + 32
+		cumulative_saved = np.cumsum(saved)
+
+		packed = pack_transitions(counts, self.order)
+		excess = packed.nbytes() + packed.vocab_nbytes() - max_bytes
+		removed = 0
+		while excess > 0 and removed < len(order):
+			# the containers of the vocabulary may shrink by less than estimated,
+			# remove more until the rebuilt table fits
+			removed = min(int(np.searchsorted(cumulative_saved, cumulative_saved[removed - 1] + excess 
+				if removed else excess)) + 1, len(order))
+			pruned = self.remove_followers(counts, keys, sizes, order[:removed])
+			packed = pack_transitions(pruned, self.order)
+			excess = packed.nbytes() + packed.vocab_nbytes() - max_bytes
+		if removed == 0:
+			return counts
+		return pruned
+
+
+	def remove_followers(self, counts, keys, sizes, removed):
+		"""
+		Helper function for prune_to_budget()
+		Returns counts without the followers at the given positions, the followers
+		of keys numbered in order, and without the contexts left empty
+		"""
+		start_key = ("\n",) if self.order > 1 else None
+		keep = np.ones(int(sizes.sum()), dtype=bool)
+		keep[removed] = False
+		pruned = {} if start_key not in counts else {start_key: counts[start_key]}
+		position = 0
+		for key, size in zip(keys, sizes.tolist()):
+			kept = {words: count for (words, count), flag in 
+				zip(counts[key].items(), keep[position:position + size].tolist()) if flag}
+			if kept:
+				pruned[key] = kept
+			position += size
+		return pruned
+
+
+	def cache_path(self, cache_dir, p, chunck_size, prune=False):
+		"""
+		Returns the path of the cached model for this corpus and these training parameters.
+		The file name is keyed by the hash of the corpus content, so editing the 
+		corpus invalidates the cache.
+		"""
+		sha = hashlib.sha1()
+		with open(self.corpus, "rb") as file:
+			for block in iter(lambda: file.read(1 << 20), b""):
+				sha.update(block)
+		name = "{hash}_{level}_o{order}_p{p}_c{chunk}{pruned}_v{version}.slm".format(hash=sha.hexdigest()[:20], 
+			level=self.level, order=self.order, p=p, chunk=chunck_size, pruned="_pruned" if prune else "", 
+			version=CACHE_VERSION)
+		return os.path.join(cache_dir, name)
+
+
+	def save(self, path):
+		"""
+		Saves the trained state of the model (vocabulary, transitions, mean and
+		standard deviation) to a compact binary file that load() can memory map.
+		The transitions are written as the arrays of a PackedTransitions, see
+		write_model_file for the layout
+
+		Parameters:
+			path: the path of the file to write
+		"""
+		# write to a temporary file first so a crash never leaves a half written cache
+		tmp_path = "{}.{}.tmp".format(path, os.getpid())
+		with open(tmp_path, "wb") as file:
+			self.write_model(file)
+		os.replace(tmp_path, path)
+
+
+	def write_model(self, file, shared=False):
+		"""
+		Helper function for save() and publish()
+		Writes the trained state of the model to a binary file object, see write_model_file.
+		With shared, the vocabulary and the lookup arrays built on first use are
+		written as arrays too, see PackedTransitions.shared_arrays
+		"""
+		packed = self.get_packed()
+		if isinstance(packed, DenseTransitions):
+			packed = packed.to_packed()
+		header = {
+			"level": self.level,
+			"order": self.order,
+			"mean": self.mean,
+			"standard_deviation": self.standard_deviation
+		}
+		arrays = packed.arrays()
+		if shared:
+			arrays.update(packed.shared_arrays())
+		else:
+			header["vocab"] = list(packed.vocab)
+		write_model_file(file, header, arrays)
+
+
+	def load(self, path):
+		"""
+		Loads a model written by save(). The file is memory mapped and used in 
+		place as the model's PackedTransitions, so the model is compact after 
+		loading (see compact()), call expand() to get self.transitions back.
+
+		Parameters:
+			path: the path of the file to read
+
+		Returns:
+			success: False if the file is empty, cut short or not a model saved
+					 by this version of SLM
+		"""
+		with open(path, "rb") as file:
+			# an empty file can't be memory mapped
+			if os.fstat(file.fileno()).st_size == 0:
+				return False
+			buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+		if not self.read_model(buffer):
+			buffer.close()
+			return False
+		return True
+
+
+	def read_model(self, buffer):
+		"""
+		Helper function for load() and attach()
+		Makes the model compact over the arrays of a buffer written by write_model,
+		without copying them
+
+		Returns:
+			success: False if the buffer is not in the expected format
+		"""
+		header, arrays = read_model_buffer(buffer)
+		if header is None:
+			return False
+
+		self.level = header["level"]
+		self.order = header["order"]
+		self.mean = header["mean"]
+		self.standard_deviation = header["standard_deviation"]
+
+		self.counts = {}
+		self.transitions = {}
+		self.samplers = {}
+		self.dirty = set()
+		if "vocab_blob" in arrays:
+			vocab = MappedVocabulary(arrays["vocab_blob"], arrays["vocab_offsets"], arrays["vocab_slots"])
+		else:
+			vocab = header["vocab"]
+		self.packed = PackedTransitions(vocab, self.order, arrays)
+		return True
+
+
+	def publish(self, directory=None):
+		"""
+		Publishes the model for other processes to attach() to: it is saved 
+		(see save()) to a file in shared memory (/dev/shm where there is one),
+		and every process that attaches maps the same pages read-only instead 
+		of holding its own copy. Besides the transitions the file holds the 
+		vocabulary and the lookup arrays a compact model builds on first use
+		(see PackedTransitions.shared_arrays), so an attached model builds 
+		nothing of the size of the model until it is changed (e.g. by update()).
+		The caller owns the file and removes it when no process needs it anymore.
+
+		Parameters:
+			directory (optional): where to write the file instead of shared memory
+
+		Returns:
+			path: the path of the published model, what attach() takes
+		"""
+		if directory is None and os.path.isdir(SHARED_MEMORY_DIR):
+			directory = SHARED_MEMORY_DIR
+		fd, path = tempfile.mkstemp(prefix="slm_", suffix=".slm", dir=directory)
+		with os.fdopen(fd, "wb") as file:
+			self.write_model(file, shared=True)
+		return path
+
+
+	def attach(self, path, seed=None):
+		"""
+		Attaches the model to a model published by publish(), usually in another
+		process. The file is memory mapped read-only (see load()), so all the 
+		processes share one copy of the arrays and of the vocabulary, whose
+		tokens are looked up through a MappedVocabulary. The model gets its own random 
+		generator seeded with seed (see seed()), e.g. one of worker_seeds().
+
+		Parameters:
+			path: the path returned by publish()
+			seed (optional): the seed of the model's random generator
+		"""
+		if not self.load(path):
+			sys.exit("ERROR: " + path + " is not a model published by this version of SLM")
+		self.seed(seed)
+
+
+	def seed(self, seed=None):
+		"""
+		Gives the model its own random generator, seeded with seed, so that 
+		what it generates is independent from the random module and from other
+		models and can be reproduced. With several worker processes, give each
+		one a seed from worker_seeds() for independent streams.
+
+		Parameters:
+			seed (optional): an int, None seeds from the system
+		"""
+		self.random = random.Random(seed)
+
+
+	def get_packed(self):
+		"""
+		Returns the PackedTransitions of this model, packing self.counts if the 
+		model is not compact yet. Exits if the contexts can't be packed, see 
+		get_scoring_table
+		"""
+		packed = self.get_scoring_table(fresh=True)
+		if packed is None:
+			sys.exit("ERROR: The vocabulary is too large to pack contexts of order {} into 64 bits.".format(self.order))
+		return packed
+
+
+	def get_scoring_table(self, fresh=False):
+		"""
+		Returns the PackedTransitions to score and sample with: the model's own 
+		if it is compact, or else self.counts packed once and kept until the 
+		model changes. Returns None if the contexts of the model can't be packed
+		into 64 bit keys (len(vocab) ** order too large, see fits_packed_keys),
+		the callers then fall back on self.counts
+
+		Parameters:
+			fresh (optional): whether to pack again a table that misses the 
+							  contexts in self.stale, see update()
+		"""
+		if self.packed is not None:
+			return self.packed
+		if fresh and self.stale:
+			self.scoring_table = None
+		if self.scoring_table is None:
+			self.stale = set()
+			# False remembers that the counts can't be packed
+			self.scoring_table = False
+			if fits_packed_keys(count_vocabulary(self.counts), self.order):
+				self.scoring_table = pack_transitions(self.counts, self.order)
+		return self.scoring_table or None
+
+
+	def compact(self):
+		"""
+		Switches the model to its compact representation: the transitions are
+		packed into integer arrays (see PackedTransitions) and the dict based
+		self.counts, self.transitions and self.samplers are dropped.
+		generate, get_likelihood and estimate keep working on the packed arrays.
+		"""
+		self.packed = self.get_packed()
+		self.scoring_table = None
+		self.stale = set()
+		self.counts = {}
+		self.transitions = {}
+		self.samplers = {}
+		self.dirty = set()
+
+
+	def densify(self):
+		"""
+		Switches the model to its dense representation, a DenseTransitions 
+		where every context is a row of follower counts over the whole 
+		vocabulary. Only meant for small vocabularies such as character level
+		models; sampling and scoring become direct array lookups. The model is
+		compact as well (see compact()), and stays dense until something 
+		rebuilds it, like expand(), update() or prune()
+		"""
+		packed = self.get_packed()
+		if not isinstance(packed, DenseTransitions):
+			packed = densify_transitions(packed)
+		self.compact()
+		self.packed = packed
+
+
+	def expand(self):
+		"""
+		Undoes compact(): rebuilds self.counts and self.transitions from the 
+		packed arrays
+		"""
+		if self.packed is None:
+			return
+		packed = self.packed
+		self.counts = packed.to_counts()
+		self.transitions = {}
+		self.populate_transitions_from_counts(self.counts)
+		# the packed arrays still score the counts, see update()
+		self.scoring_table = packed
+		self.stale = set()
+
+
+	def get_sampler(self, key):
+		"""
+		Helper function for find_next()
+		Returns the candidates that follow key together with their upper bounds, 
+		a sorted list that a random float can be binary searched in.
+		Samplers are built on first use and kept in self.samplers
+
+		Parameters:
+			key: a tuple of tokens
+
+		Returns:
+			(words, upper_bounds): the list of candidates and the list of their upper bounds
+		"""
+		sampler = self.samplers.get(key)
+		if sampler is None:
+			# renormalize a context update() added counts to
+			if key in self.dirty:
+				self.transitions[key] = self.transition_bounds(self.counts[key])
+				self.dirty.discard(key)
+			try:
+				candidates = self.transitions[key]
+			# when key is not a valid ngram (key does not exist in transitions)
+			except KeyError:
+				raise KeyError("ERROR: the key \"{}\" does not exist in the corpus.".format((" ").join(key)))
+			# scale the bounds by the last one so float rounding can never fall past the end
+			total = candidates[-1][1][1]
+			sampler = ([candidate[0] for candidate in candidates], [candidate[1][1] / total for candidate in candidates])
+			self.samplers[key] = sampler
+		return sampler
+
+
+	def find_next(self, key):
+		"""
+		Helper function for generate()
+		Probabilistically finds the next word from transitions, given key
+		
+		Parameters:
+			key: a tuple of tokens
+		"""
+		key = tuple(key)
+		if self.packed is not None:
+			if len(key) != self.order:
+				return self.packed.sample_start((self.random or random).random())
+			row = self.packed.find_row(self.packed.pack(key))
+			if row < 0:
+				raise KeyError("ERROR: the key \"{}\" does not exist in the corpus.".format((" ").join(key)))
+			return [self.packed.vocab[self.packed.sample_row(row, (self.random or random).random())]]
+
+		words, upper_bounds = self.get_sampler(key)
+		return words[bisect.bisect_right(upper_bounds, (self.random or random).random())]
+
+	
+	def eliminate_white_space_on_symbol(self, string):
+		"""
+		Helper function for generate()
+		Removes whitespaces that come before symbols
+		"""
+		return WHITE_SPACE_ON_SYMBOL_PATTERN.sub("", string)
+
+
+	def generate(self, length, prompt="\n"):
+		""""
+		Generates text with the size of a given length based on the trained model. 
+
+		The prompt is an optional starting word(s) for the generated text. 
+		The text starts from the last `order` tokens of the prompt if they 
+		were seen in the corpus, or else from a context that starts with the 
+		longest end of the prompt that any context starts with (see 
+		find_starter). If there is none the function will use a random text 
+		as a starting prompt
+
+		Parameters:
+			length: the length of the text to be generated (measured by tokens)
+			prompt (optinal): text to start off
+
+		Returns:    
+			result: generated string or None if prompt is invalid or generate 
+					runs into an edge case where focused_phrase is not in the 
+					transitions dict
+		"""
+		stream = self.generate_iter(length, prompt)
+		result = ("").join(stream)
+		if stream.dead_end:
+			return None
+		return result
+
+
+	def generate_iter(self, length, prompt="\n", sentence=False):
+		"""
+		Same as generate, but returns a TextStream that samples the tokens one 
+		at a time and yields the text as it is generated, so it can be shown
+		right away or stopped early
+
+		Parameters:
+			length: the length of the text to be generated (measured by tokens)
+			prompt (optinal): text to start off
+			sentence (optional): whether to stop after the first sampled token 
+								 that ends a sentence, see generate_sentence
+
+		Returns:
+			stream: a TextStream, its dead_end is True if the prompt is invalid 
+					or it runs into a context that is not in the transitions dict
+		"""
+		tokenized_prompt = [] 
+		if self.level == "word":
+			tokenized_prompt = self.split_with_word(prompt)
+
+		elif self.level == "character":
+			tokenized_prompt = self.split_with_character(prompt)
+
+		else:
+			sys.exit("ERROR: Invalid level parameter: " + self.level + \
+				"\nlevel should either be \"word\" or \"character\"")
+
+		# Generate the starter of the sentence, the default prompt asks for a random one
+		starter = None
+		if tokenized_prompt != ["\n"]:
+			starter = self.find_starter(tokenized_prompt)
+		if starter is None:
+			# print("NOTICE: The prompt is too short or it is not provided, we will generate a sentence randomly.\n")
+			try:
+				starter = list.copy(self.find_next("\n"))
+			except KeyError as err:
+				# print(err) # should never reach this except
+				return TextStream(self, None, 0, sentence)
+
+		return TextStream(self, starter, length - self.order, sentence)
+
+
+	def find_starter(self, tokenized_prompt):
+		"""
+		Helper function for generate_iter()
+		Finds the context to start generating from for a prompt: the last 
+		`order` tokens of the prompt if they are a context of the model, or 
+		else a context that starts with the last order - 1, order - 2, ... 1
+		tokens of the prompt, drawn by how often it was seen. The contexts
+		are looked up by prefix in PackedTransitions.get_prefix_index, or in 
+		self.counts if the model can't be packed (see find_starter_in_counts)
+
+		Parameters:
+			tokenized_prompt: the prompt as a list of tokens
+
+		Returns:
+			starter: a list of `order` tokens, or None if no context matches the prompt
+		"""
+		packed = self.get_scoring_table()
+		if packed is None:
+			return self.find_starter_in_counts(tokenized_prompt)
+		if len(tokenized_prompt) >= self.order:
+			starter = tokenized_prompt[-self.order:]
+			if packed is self.packed:
+				if packed.find_row(packed.pack(starter)) >= 0:
+					return starter
+			elif tuple(starter) in self.counts:
+				return starter
+
+		for length in range(min(len(tokenized_prompt), self.order - 1), 0, -1):
+			prefix = tuple(tokenized_prompt[-length:])
+			# contexts that changed after the table was packed are weighted by their counts
+			stale = [key for key in self.stale if len(key) == self.order and key[:length] == prefix]
+			if stale and packed is self.scoring_table:
+				starter = self.sample_stale_prefix(packed, prefix, stale)
+			else:
+				starter = packed.sample_prefix(prefix, (self.random or random).random())
+			if starter is not None:
+				return starter
+		return None
+
+
+	def sample_stale_prefix(self, packed, prefix, stale):
+		"""
+		Helper function for find_starter()
+		Same as PackedTransitions.sample_prefix on a scoring table where some 
+		contexts that start with prefix changed after it was packed (see 
+		update()): those stale contexts are weighted by self.counts
+		"""
+		weights = {}
+		rows = packed.prefix_rows(prefix)
+		if rows is not None:
+			lo, hi = rows
+			for key, total in zip(packed.context_keys[lo:hi].tolist(), packed.row_totals(lo, hi).tolist()):
+				weights[tuple(packed.unpack(key, self.order))] = total
+		for key in stale:
+			weights[key] = sum(self.counts[key].values())
+		return list((self.random or random).choices(list(weights), list(weights.values()))[0])
+
+
+	def find_starter_in_counts(self, tokenized_prompt):
+		"""
+		Helper function for find_starter()
+		Same as find_starter, for a model whose contexts can't be packed (see 
+		get_scoring_table): the contexts are looked up in self.counts, and 
+		every prefix scans all of them
+		"""
+		if len(tokenized_prompt) >= self.order and tuple(tokenized_prompt[-self.order:]) in self.counts:
+			return tokenized_prompt[-self.order:]
+
+		for length in range(min(len(tokenized_prompt), self.order - 1), 0, -1):
+			prefix = tuple(tokenized_prompt[-length:])
+			contexts = [key for key in self.counts if len(key) == self.order and key[:length] == prefix]
+			if contexts:
+				weights = [sum(self.counts[key].values()) for key in contexts]
+				return list((self.random or random).choices(contexts, weights)[0])
+		return None
+
+
+	def generate_sentence(self, max_length, prompt="\n"):
+		"""
+		Generates text until the end of a sentence (a token in SENTENCE_END_TOKENS)
+		or until max_length tokens, whichever comes first. On a model trained 
+		with prune=True (see prune_dead_ends) this always succeeds
+
+		Parameters:
+			max_length: the maximum length of the text (measured by tokens)
+			prompt (optinal): text to start off
+
+		Returns:
+			result: generated string or None if prompt is invalid or generation 
+					runs into a context that is not in the transitions dict
+		"""
+		stream = self.generate_iter(max_length, prompt, sentence=True)
+		result = ("").join(stream)
+		if stream.dead_end:
+			return None
+		return result
+
+
+	def generate_batch(self, n, length, seed=None):
+		"""
+		Generates n texts of a given length at once, the same as calling 
+		generate(length) n times without a prompt. All the chains advance in 
+		lockstep over the packed transition arrays with batched random draws
+		(see PackedTransitions.walk_batch), which is much faster for large n.
+		A model whose contexts can't be packed (see get_scoring_table) calls 
+		generate n times instead, drawing from the model's random generator, not seed.
+
+		Parameters:
+			n: the number of texts to generate
+			length: the length of every text (measured by tokens)
+			seed (optional): an int seed or a numpy random Generator for the draws, 
+							 drawn from the model's random generator by default (see seed())
+
+		Returns:
+			results: a list of n generated strings, None for the samples that run 
+					 into a context that is not in the transitions dict
+		"""
+		packed = self.get_scoring_table(fresh=True)
+		if packed is None:
+			return [self.generate(length) for _ in range(n)]
+		if seed is None and self.random is not None:
+			seed = self.random.getrandbits(64)
+		ids, alive = packed.walk_batch(n, length, np.random.default_rng(seed))
+
+		# only the tokens the chains used are looked up in the vocabulary
+		used, inverse = np.unique(ids[alive], return_inverse=True)
+		tokens = np.array([packed.vocab[token_id] for token_id in used.tolist()] + [""], dtype=object)
+		results = [None] * n
+		for i, tokens in zip(np.flatnonzero(alive).tolist(), tokens[inverse].reshape(-1, ids.shape[1]).tolist()):
+			results[i] = self.eliminate_white_space_on_symbol((" ").join(tokens) + " ")
+		return results
+
+
+	def get_likelihood(self, tokenized_text):
+		"""
+		Gets the likelihood that a given tokenized_text is generated by this model.
+		Every position is scored at once, see score_tokens
+		
+		Parameters: 
+			tokenized_text: the text as a list of tokens
+		Returns:
+			raw_score: the sum of probability of all the grams being generated by this model
+		"""
+		return float(self.score_tokens(tokenized_text).sum())
+
+
+	def score_tokens(self, tokenized_text):
+		"""
+		Scores every position of a tokenized text. The text is encoded into 
+		token ids and scored in one batch, see PackedTransitions.score_ids. A
+		model whose contexts can't be packed (see get_scoring_table) is scored 
+		from self.counts one position at a time instead, with the same scores,
+		and so are the positions the packed table misses after update(): those
+		in a context that changed, or with a token the table does not know
+
+		Parameters:
+			tokenized_text: the text as a list of tokens
+
+		Returns:
+			scores: a float64 array where scores[i] is the probability that tokenized_text[i]
+					follows the `order` tokens before it, 0.0 for the first `order` 
+					positions and for unseen ngrams
+		"""
+		packed = self.get_scoring_table()
+		if packed is None:
+			scores = np.zeros(len(tokenized_text))
+			self.score_from_counts(tokenized_text, scores, range(self.order, len(tokenized_text)))
+			return scores
+
+		ids = packed.encode(tokenized_text)
+		scores = packed.score_ids(ids)
+		if self.stale and packed is self.scoring_table:
+			self.score_from_counts(tokenized_text, scores, self.stale_positions(packed, ids).tolist())
+		return scores
+
+
+	def score_from_counts(self, tokenized_text, scores, positions):
+		"""
+		Helper function for score_tokens()
+		Scores the given positions of a tokenized text from self.counts into scores
+		"""
+		totals = {}
+		for i in positions:
+			key = tuple(tokenized_text[i - self.order:i])
+			followers = self.counts.get(key, {})
+			count = followers.get((tokenized_text[i],), 0)
+			if count and key not in totals:
+				totals[key] = sum(followers.values())
+			scores[i] = count / totals[key] if count else 0.0
+
+
+	def stale_positions(self, packed, ids):
+		"""
+		Helper function for score_tokens()
+		Returns the positions of an encoded text that the scoring table misses 
+		after update(): those in a context of self.stale or with a token outside
+		its vocabulary (id -1)
+		"""
+		order = self.order
+		if len(ids) <= order:
+			return np.empty(0, dtype=np.int64)
+		windows = np.lib.stride_tricks.sliding_window_view(ids[:-1], order)
+		missed = (windows < 0).any(axis=1) | (ids[order:] < 0)
+		stale = [packed.pack(key) for key in self.stale if len(key) == order]
+		stale = np.array([key for key in stale if key is not None], dtype=np.int64)
+		keys = windows @ (packed.base ** np.arange(order - 1, -1, -1, dtype=np.int64))
+		return np.flatnonzero(missed | np.isin(keys, stale)) + order
+
+
+	def score_chunks(self, tokenized_text, bounds):
+		"""
+		Gets the likelihood of many chunks of a text with one scoring pass over the text.
+		Matches calling get_likelihood(tokenized_text[start:end]) on every chunk: 
+		the first `order` tokens of a chunk only serve as context.
+
+		Parameters:
+			tokenized_text: the text as a list of tokens
+			bounds: a list of (start, end) of consecutive chunks covering tokenized_text[bounds[0][0]:]
+
+		Returns:
+			raw_scores: a float64 array of the raw likelihood of every chunk
+		"""
+		first = bounds[0][0]
+		index = LikelihoodIndex(self, tokenized_text[first:bounds[-1][1]])
+		return index.chunk_likelihoods([(start - first, end - first) for start, end in bounds])
+
+
+	def likelihood_index(self, test_size):
+		"""
+		Builds a LikelihoodIndex over the test portion of the model's tokenized_list
+
+		Parameters:
+			test_size: the size of the test portion (out of a 100)
+		"""
+		tokenized_list_length = len(self.tokenized_list)
+		start = int(tokenized_list_length * (100 - test_size) / 100) 
+		
+		if (start + self.order > tokenized_list_length):
+			sys.exit("ERROR: The text to be estimated is too small")
+
+		return LikelihoodIndex(self, self.tokenized_list[start:])
+
+
+	def z_score_estimator(self, chunk_size, test_size):
+		"""
+		Calculates the mean and the standard_deviation of the likihoods from the test
+		portion of the model's tokenized_list by splitting the test portion into chunks
+
+		Parameters:
+			chunk_size: the numbers of words in each chunk
+			test_size: the size of the test portion (out of a 100)
+		"""
+		index = self.likelihood_index(test_size)
+		self.mean, self.standard_deviation = index.chunk_statistics(chunk_size)
+
+
+	def calibrate(self, chunk_sizes, test_size):
+		"""
+		Sweeps the z score estimator over many chunk sizes. The test portion is
+		scored once, every chunk size after that only costs one subtraction per chunk.
+		Does not change the model, assign the chosen mean and standard_deviation 
+		(or call z_score_estimator) to use one of the results
+
+		Parameters:
+			chunk_sizes: a list of chunk sizes to try
+			test_size: the size of the test portion (out of a 100)
+
+		Returns:
+			statistics: a dict of chunk_size -> (mean, standard_deviation)
+		"""
+		index = self.likelihood_index(test_size)
+		return {chunk_size: index.chunk_statistics(chunk_size) for chunk_size in chunk_sizes}
+
+
+	def estimate(self, input_text):
+		"""
+		Finds the z_score of the input_text given the z score estimator
+
+		Parameters:
+			input_text: the string that is the input text
+
+		Returns:
+			input_z_score: the z_score of the input text estimated by the z_score_estimator of this model
+		"""
+		return self.estimate_tokens(self.split_with_word(input_text))
+
+
+	def estimate_tokens(self, tokenized_input):
+		"""
+		Finds the z_score of an already tokenized text given the z score estimator
+
+		Parameters:
+			tokenized_input: the text as a list of tokens
+
+		Returns:
+			input_z_score: the z_score of the text estimated by the z_score_estimator of this model
+		"""
+		# calculate likelihood and zscore
+		input_likelihood = self.get_likelihood(tokenized_input) / len(tokenized_input)
+		input_z_score = (input_likelihood - self.mean) / self.standard_deviation
+
+		return input_z_score
+
+
+	def estimate_chunks(self, tokenized_text, bounds):
+		"""
+		Finds the z_score of every chunk of a tokenized text with one scoring pass,
+		the same as calling estimate_tokens on every chunk
+
+		Parameters:
+			tokenized_text: the text as a list of tokens
+			bounds: a list of (start, end) of consecutive chunks, see chunk_bounds
+
+		Returns:
+			z_scores: a float64 array of the z_score of every chunk
+		"""
+		sizes = np.array([end - start for start, end in bounds])
+		likelihoods = self.score_chunks(tokenized_text, bounds) / sizes
+		return (likelihoods - self.mean) / self.standard_deviation
+
+		
+class TextStream:
+	"""
+	Class TextStream iterates over the text generated by SLM.generate_iter.
+	Every step samples one token and yields the part of the text that is 
+	final once that token is known, with the whitespace before symbols 
+	removed like SLM.eliminate_white_space_on_symbol. Joining everything 
+	it yields gives the same string as SLM.generate
+	"""
+
+	def __init__(self, model, starter, steps, sentence=False):
+		"""
+		Intializer of TextStream
+
+		Parameters:
+			model: the trained SLM to sample from
+			starter: the `order` tokens to start with, or None if there is no valid start
+			steps: the number of tokens to sample after the starter
+			sentence (optional): whether to stop after a sampled token in SENTENCE_END_TOKENS
+		"""
+		self.model = model
+		# every token so far, before the whitespace is cleaned up
+		self.tokens = list(starter or [])
+		# the last `order` tokens, the key of the next sample
+		self.context = tuple(self.tokens)
+		# the packed key of context when the model is compact, see PackedTransitions.walk
+		self.key = None
+		self.steps = steps
+		self.sentence = sentence
+		# the model's own random generator if it has one, see SLM.seed
+		self.random_float = (model.random or random).random
+		# True once the stream reaches a context that is not in the transitions
+		self.dead_end = starter is None
+		# number of tokens in self.tokens whose text has been yielded
+		self.emitted = 0
+		# a run of whitespace that is kept or dropped depending on the character after it
+		self.white_space = ""
+		self.finished = False
+
+
+	def __iter__(self):
+		return self
+
+
+	def __next__(self):
+		while not self.finished:
+			if self.emitted == len(self.tokens) and not self.sample():
+				# the last whitespace of a run is kept at the end of the text
+				self.finished = True
+				text, self.white_space = self.white_space[-1:], ""
+			else:
+				text = self.clean(self.tokens[self.emitted])
+				self.emitted += 1
+			if text:
+				return text
+		raise StopIteration
+
+
+	def sample(self):
+		"""
+		Helper function for __next__()
+		Samples the next token into self.tokens, returns False if there is none
+		"""
+		if self.dead_end or self.steps <= 0:
+			return False
+		packed = self.model.packed
+		if packed is None:
+			try:
+				words, upper_bounds = self.model.samplers.get(self.context) or self.model.get_sampler(self.context)
+			# catch edge case when context is not in the corpus
+			except KeyError as err:
+				self.dead_end = True
+				return False
+			token = words[bisect.bisect_right(upper_bounds, self.random_float())][0]
+		else:
+			# same steps as PackedTransitions.walk, the key is shifted instead of packed again
+			if self.key is None:
+				self.key = packed.pack(self.context)
+			row = packed.find_row(self.key)
+			if row < 0:
+				self.dead_end = True
+				return False
+			next_id = packed.sample_row(row, self.random_float())
+			token = packed.vocab[next_id]
+			self.key = (self.key % packed.high) * packed.base + next_id
+		self.steps -= 1
+		if self.sentence and token in SENTENCE_END_TOKENS:
+			self.steps = 0
+		self.tokens.append(token)
+		self.context = self.context[1:] + (token,)
+		return True
+
+
+	def clean(self, token):
+		"""
+		Helper function for __next__()
+		Returns the text of the token and the space after it that is final, 
+		keeping the trailing whitespace in self.white_space. A run of whitespace 
+		is dropped before a symbol and shortened to its last character otherwise,
+		the same as removing the matches of WHITE_SPACE_ON_SYMBOL_PATTERN from 
+		the whole text
+		"""
+		starts_with_word = TOKEN_KINDS.get(token)
+		if starts_with_word is None:
+			# tokens with whitespace in them go through the run one character at a time
+			if not token or any(char.isspace() for char in token):
+				return self.clean_characters(token + " ")
+			starts_with_word = TOKEN_KINDS[token] = WORD_CHARACTER_PATTERN.match(token) is not None
+
+		text = token
+		if self.white_space and starts_with_word:
+			text = self.white_space[-1] + token
+		self.white_space = " "
+		return text
+
+
+	def clean_characters(self, string):
+		"""
+		Helper function for clean()
+		Same as clean for any string, one character at a time
+		"""
+		result = []
+		for char in string:
+			if char.isspace():
+				self.white_space += char
+				continue
+			if self.white_space:
+				if WORD_CHARACTER_PATTERN.match(char):
+					result.append(self.white_space[-1])
+				self.white_space = ""
+			result.append(char)
+		return ("").join(result)
+
+
+	def copy(self):
+		"""
+		Returns an independent TextStream in the same state, e.g. to sample 
+		the rest of the text again from here
+		"""
+		stream = TextStream(self.model, self.tokens, self.steps, self.sentence)
+		stream.context = self.context
+		stream.key = self.key
+		stream.dead_end = self.dead_end
+		stream.emitted = self.emitted
+		stream.white_space = self.white_space
+		stream.finished = self.finished
+		return stream
+
+
+class LikelihoodIndex:
+	"""
+	Class LikelihoodIndex holds the score of every position of one tokenized text
+	under one SLM together with their prefix sums, so the likelihood of any 
+	window of the text is answered in constant time
+	"""
+
+	def __init__(self, model, tokenized_text):
+		"""
+		Intializer of LikelihoodIndex, scores the whole text once
+
+		Parameters:
+			model: a trained SLM
+			tokenized_text: the text as a list of tokens
+		"""
+		self.order = model.order
+		self.length = len(tokenized_text)
+		scores = model.score_tokens(tokenized_text)
+		# prefix[i] is the sum of the scores of the positions before i
+		self.prefix = np.concatenate(([0.0], np.cumsum(scores)))
+
+
+	def likelihood(self, start, end):
+		"""
+		Returns the likelihood of the window tokenized_text[start:end], the same 
+		as SLM.get_likelihood on that slice: its first `order` tokens only serve as context
+		"""
+		first = min(start + self.order, end)
+		return float(self.prefix[end] - self.prefix[first])
+
+
+	def chunk_likelihoods(self, bounds):
+		"""
+		Returns the likelihood of every window in bounds, a list of (start, end), as a float64 array
+		"""
+		bounds = np.array(bounds, dtype=np.int64).reshape(-1, 2)
+		starts, ends = bounds[:, 0], bounds[:, 1]
+		return self.prefix[ends] - self.prefix[np.minimum(starts + self.order, ends)]
+
+
+	def chunk_statistics(self, chunk_size, start=0):
+		"""
+		Splits the text from start into chunks (see chunk_bounds) and calculates 
+		the mean and the standard_deviation of their likelihoods normalized by size
+
+		Returns:
+			(mean, standard_deviation)
+		"""
+		bounds = chunk_bounds(start, self.length, chunk_size)
+		# normalizes the likelihood by dividing with the size
+		sizes = np.array([end - start for start, end in bounds])
+		chunk_raw_scores = (self.chunk_likelihoods(bounds) / sizes).tolist()
+
+		# cal sd and mean
+		return sum(chunk_raw_scores) / len(chunk_raw_scores), statistics.stdev(chunk_raw_scores)
+
+
+class NgramTrie:
+	"""
+	Class NgramTrie is a statistical language model of every order from 1 to 
+	max_order at once. The ngrams of all the lengths up to max_order + 1 are 
+	counted in a single pass over the tokens into one trie, where the node of 
+	an ngram holds its count and the nodes of the tokens that follow it, so 
+	the model of order k is read from the depth k of the trie.
+	At any order it generates and scores text like an SLM of that order 
+	trained on the same corpus, and it can back off to shorter contexts.
+	"""
+
+	def __init__(self, corpus, level, max_order):
+		"""
+		Intializer of NgramTrie
+		Parameters: 
+			corpus: a string for the pathfile to the corpus
+			level: "word" or "character", the level to train on
+			max_order: the highest order to be served
+		"""
+		self.corpus = corpus
+		self.level = level
+		self.max_order = max_order
+		# an SLM of the same corpus and level, used for its tokenizers
+		self.tokenizer = SLM(corpus, level, max_order)
+		'''
+		self.root = [
+			total_count, 
+			{
+				'token': [count, {'next_token': [count, {...}], ...}],
+				...
+			}
+		]
+		'''
+		self.root = [0, {}]
+		# context tuple -> (list of followers, cumulative upper bounds), built lazily
+		self.samplers = {}
+		# order -> (list of starting tuples, cumulative upper bounds), built lazily
+		self.start_samplers = {}
+
+
+	def train(self, p=100):
+		"""
+		Tokenizes the corpus once and counts every ngram of length 1 to 
+		max_order + 1 from the beginning of the tokens in a single pass
+
+		Parameters:
+			p (optional): a number between 0 and 100 representing how much of 
+						  the corpus should be trained from the beginning
+		"""
+		tokens = list(self.tokenizer.tokenize_file())
+		if len(tokens) < self.max_order:
+			sys.exit("ERROR: The corpus is smaller than the order." +\
+			"\nLower the order or change to a bigger corpus")
+
+		# the \n SLM.populate_transitions_from_lst inserts in front of the tokens
+		tokens.insert(0, "\n")
+		tokens = tokens[:int(len(tokens)/100*p)]
+
+		self.root = [0, {}]
+		self.samplers = {}
+		self.start_samplers = {}
+		depth = self.max_order + 1
+		for i in range(len(tokens)):
+			node = self.root
+			node[0] += 1
+			for token in tokens[i:i + depth]:
+				children = node[1]
+				node = children.get(token)
+				if node is None:
+					node = children[token] = [0, {}]
+				node[0] += 1
+
+
+	def find_node(self, ngram):
+		"""
+		Returns the trie node of the given tuple of tokens, or None if it was never seen
+		"""
+		node = self.root
+		for token in ngram:
+			node = node[1].get(token)
+			if node is None:
+				return None
+		return node
+
+
+	def get_sampler(self, context):
+		"""
+		Returns the followers of a context together with their upper bounds
+		(see SLM.get_sampler), or None if the context was never followed by 
+		anything. Samplers are built on first use and kept in self.samplers
+
+		Parameters:
+			context: a tuple of at most max_order tokens
+		"""
+		sampler = self.samplers.get(context)
+		if sampler is None:
+			node = self.find_node(context)
+			if node is None or not node[1]:
+				return None
+			followers = list(node[1])
+			counts = itertools.accumulate(child[0] for child in node[1].values())
+			total = sum(child[0] for child in node[1].values())
+			sampler = (followers, [count / total for count in counts])
+			self.samplers[context] = sampler
+		return sampler
+
+
+	def find_sampler(self, context, backoff):
+		"""
+		Helper function for generate() and get_likelihood()
+		Returns the sampler of context, or with backoff the one of its longest
+		suffix that was followed by something (the unigrams at worst); None 
+		if there is none
+		"""
+		for start in range(len(context) + 1 if backoff else 1):
+			sampler = self.get_sampler(context[start:])
+			if sampler is not None:
+				return sampler
+		return None
+
+
+	def get_start_sampler(self, order):
+		"""
+		Helper function for generate()
+		Returns the tuples of `order` tokens that follow a "\n" with their upper 
+		bounds, the ("\n",) special case of an SLM of that order
+		"""
+		sampler = self.start_samplers.get(order)
+		if sampler is None:
+			starts, counts = [], []
+			# depth first over the `order` levels under the "\n" node
+			stack = [((), self.root[1].get("\n", [0, {}]))]
+			while stack:
+				ngram, node = stack.pop()
+				if len(ngram) == order:
+					starts.append(ngram)
+					counts.append(node[0])
+					continue
+				for token, child in node[1].items():
+					stack.append((ngram + (token,), child))
+			total = sum(counts)
+			sampler = (starts, [count / total for count in itertools.accumulate(counts)])
+			self.start_samplers[order] = sampler
+		return sampler
+
+
+	def check_order(self, order):
+		"""
+		Helper function that returns the order to use, max_order if order is None
+		"""
+		if order is None:
+			return self.max_order
+		if not 1 <= order <= self.max_order:
+			sys.exit("ERROR: Invalid order: " + str(order) + \
+				"\norder should be between 1 and " + str(self.max_order))
+		return order
+
+
+	def generate(self, length, prompt="\n", order=None, backoff=False):
+		"""
+		Generates text with the size of a given length from the model of the 
+		given order, like SLM.generate. 
+
+		Without backoff, a prompt shorter than the order is replaced by a 
+		random start and generation fails on a context that was never 
+		followed by anything. With backoff, any prompt of at least one token
+		is used as it is, and such contexts are shortened from the front until
+		one was followed by something.
+
+		Parameters:
+			length: the length of the text to be generated (measured by tokens)
+			prompt (optinal): text to start off
+			order (optional): the order of the model, max_order by default
+			backoff (optional): whether to back off to shorter contexts
+
+		Returns:
+			result: generated string or None if there is no valid start or 
+					generation runs into a context that was never followed
+		"""
+		order = self.check_order(order)
+		if self.level == "word":
+			tokenized_prompt = self.tokenizer.split_with_word(prompt)
+		else:
+			tokenized_prompt = self.tokenizer.split_with_character(prompt)
+
+		if len(tokenized_prompt) >= order or (backoff and tokenized_prompt):
+			result = tokenized_prompt[-order:]
+		else:
+			starts, upper_bounds = self.get_start_sampler(order)
+			if not starts:
+				return None
+			result = list(starts[bisect.bisect_right(upper_bounds, random.random())])
+
+		for k in range(len(result), length):
+			sampler = self.find_sampler(tuple(result[-order:]), backoff)
+			if sampler is None:
+				return None
+			followers, upper_bounds = sampler
+			result.append(followers[bisect.bisect_right(upper_bounds, random.random())])
+
+		return WHITE_SPACE_ON_SYMBOL_PATTERN.sub("", (" ").join(result) + " ")
+
+
+	def probability(self, context, token, backoff=False):
+		"""
+		Returns the probability that token follows context, 0.0 if unseen. 
+		With backoff the context is shortened like in generate()
+		"""
+		node = self.find_node(context)
+		if backoff:
+			for start in range(1, len(context) + 1):
+				if node is not None and node[1]:
+					break
+				node = self.find_node(context[start:])
+		if node is None or token not in node[1]:
+			return 0.0
+		return node[1][token][0] / sum(child[0] for child in node[1].values())
+
+
+	def get_likelihood(self, tokenized_text, order=None, backoff=False):
+		"""
+		Gets the likelihood that a given tokenized_text is generated by the model
+		of the given order, the same as SLM.get_likelihood at that order
+
+		Parameters: 
+			tokenized_text: the text as a list of tokens
+			order (optional): the order of the model, max_order by default
+			backoff (optional): whether to back off to shorter contexts
+		Returns:
+			raw_score: the sum of probability of all the grams being generated by this model
+		"""
+		order = self.check_order(order)
+		raw_score = 0.0
+		for i in range(order, len(tokenized_text)):
+			raw_score += self.probability(tuple(tokenized_text[i - order:i]), tokenized_text[i], backoff)
+		return raw_score
+
+
+	def get_counts(self, order):
+		"""
+		Returns the counts of the model of the given order in the format of 
+		SLM.counts, including the ("\n",) special case
+		"""
+		order = self.check_order(order)
+		counts = {}
+		stack = [((), self.root)]
+		while stack:
+			ngram, node = stack.pop()
+			if len(ngram) == order:
+				if node[1]:
+					counts[ngram] = {(token,): child[0] for token, child in node[1].items()}
+				continue
+			for token, child in node[1].items():
+				stack.append((ngram + (token,), child))
+
+		if order > 1:
+			starts, upper_bounds = self.get_start_sampler(order)
+			start_counts = {}
+			for start in starts:
+				start_counts[start] = self.find_node(("\n",) + start)[0]
+			if start_counts:
+				counts[("\n",)] = start_counts
+		elif ("\n",) in counts:
+			# an SLM of order 1 counts the followers of "\n" twice
+			counts[("\n",)] = {words: 2 * count for words, count in counts[("\n",)].items()}
+		return counts
+
+
+	def get_slm(self, order):
+		"""
+		Returns an SLM of the given order built from the trie without 
+		retokenizing or recounting, e.g. to use its packed scoring
+		"""
+		slm = SLM(self.corpus, self.level, self.check_order(order))
+		slm.counts = self.get_counts(order)
+		slm.populate_transitions_from_counts(slm.counts)
+		return slm
+
+
+class MappedVocabulary:
+	"""
+	Class MappedVocabulary is a read-only vocabulary over arrays that can be
+	views of a mapped file, so the processes that attach a published model 
+	(see SLM.publish) share it instead of each holding its own token strings.
+	It stands for both the vocab list and the token_ids dict of a 
+	PackedTransitions: indexing it by id decodes a token, get() looks a token
+	up in an open addressing hash table. The arrays are built by vocabulary_arrays
+	"""
+
+	def __init__(self, blob, offsets, slots):
+		"""
+		Intializer of MappedVocabulary
+
+		Parameters:
+			blob: uint8 (b,), the utf-8 bytes of all the tokens, in id order
+			offsets: int64 (n + 1,), token i is blob[offsets[i]:offsets[i+1]]
+			slots: int32 (s,), a hash table of s (a power of two) slots holding
+				   token ids or -1, a token starts probing at crc32 % s
+		"""
+		self.arrays = {"vocab_blob": blob, "vocab_offsets": offsets, "vocab_slots": slots}
+		# memoryviews index to python ints and compare to bytes without copying
+		self.blob = memoryview(blob)
+		self.offsets = memoryview(offsets)
+		self.slots = memoryview(slots)
+		self.mask = len(slots) - 1
+
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+
+	def __getitem__(self, token_id):
+		return str(self.blob[self.offsets[token_id]:self.offsets[token_id + 1]], "utf-8")
+
+
+	def __iter__(self):
+		return map(self.__getitem__, range(len(self)))
+
+
+	def get(self, token, default=None):
+		"""
+		Returns the id of token, or default if it is not in the vocabulary
+		"""
+		data = token.encode("utf-8")
+		slot = zlib.crc32(data) & self.mask
+		while True:
+			token_id = self.slots[slot]
+			if token_id < 0:
+				return default
+			if self.blob[self.offsets[token_id]:self.offsets[token_id + 1]] == data:
+				return token_id
+			slot = (slot + 1) & self.mask
+
+
+	def nbytes(self):
+		"""
+		Returns the number of bytes held by the arrays of this vocabulary
+		"""
+		return sum(array.nbytes for array in self.arrays.values())
+
+
+class PackedTransitions:
+	"""
+	Class PackedTransitions is the compact, read-only form of an SLM's transitions.
+
+	Tokens are interned to integer ids, every context (ngram) is packed into a 
+	single integer key (the ids read as digits in base len(vocab)), and the 
+	followers are stored CSR-style in contiguous arrays:
+		context_keys: sorted int64 (n,), the packed key of every context
+		offsets: int64 (n + 1,), followers of row i are next_ids[offsets[i]:offsets[i+1]]
+		next_ids: int32 (e,), the id of each follower, sorted within a row
+		cumulative: int64 (e,), running total of the follower counts over all rows
+		start_keys: int64 (m,), packed `order` tokens that follow a "\n"
+		start_cumulative: int64 (m,), running total of the start_keys counts
+	"""
+
+	def __init__(self, vocab, order, arrays):
+		"""
+		Intializer of PackedTransitions
+
+		Parameters:
+			vocab: a list of tokens, the position of a token is its id, or a MappedVocabulary
+			order: the order of the SLM the transitions belong to
+			arrays: a dict of the arrays listed above, may be views over a mapped file.
+					It may also hold the arrays of shared_arrays, which are then not rebuilt
+		"""
+		self.vocab = vocab
+		# a MappedVocabulary looks its tokens up itself
+		self.token_ids = vocab if isinstance(vocab, MappedVocabulary) else {token: i for i, token in enumerate(vocab)}
+		self.order = order
+		self.base = max(len(vocab), 1)
+		# dropping the oldest token of a key is key % high
+		self.high = self.base ** (order - 1)
+		self.context_keys = arrays["context_keys"]
+		self.offsets = arrays["offsets"]
+		self.next_ids = arrays["next_ids"]
+		self.cumulative = arrays["cumulative"]
+		self.start_keys = arrays["start_keys"]
+		self.start_cumulative = arrays["start_cumulative"]
+		self.edge_keys = arrays.get("edge_keys")
+		self.edge_targets = arrays.get("edge_targets")
+		self.row_ends = arrays.get("row_ends")
+		self.prefix_index = None
+		if "prefix_keys" in arrays:
+			self.prefix_index = {name: arrays[name] for name in ("prefix_keys", "prefix_rows", "prefix_bounds")}
+
+
+	def __getstate__(self):
+		# only the vocabulary and the arrays are pickled, the rest is rebuilt
+		return list(self.vocab), self.order, {name: np.ascontiguousarray(array) for name, array in self.arrays().items()}
+
+
+	def __setstate__(self, state):
+		self.__init__(*state)
+
+
+	def arrays(self):
+		"""
+		Returns the arrays of this table as a dict, in the form __init__ takes them
+		"""
+		return {
+			"context_keys": self.context_keys,
+			"offsets": self.offsets,
+			"next_ids": self.next_ids,
+			"cumulative": self.cumulative,
+			"start_keys": self.start_keys,
+			"start_cumulative": self.start_cumulative
+		}
+
+
+	def shared_arrays(self):
+		"""
+		Returns what an attached model would otherwise build for itself, as 
+		arrays to write next to the ones of arrays() (see SLM.publish): the 
+		vocabulary (see vocabulary_arrays), the edge keys and targets, the row
+		ends and the prefix index. Builds the ones not built yet
+		"""
+		self.get_prefix_index()
+		arrays = vocabulary_arrays(self.vocab)
+		arrays.update({
+			"edge_keys": self.get_edge_keys(),
+			"edge_targets": self.get_edge_targets(),
+			"row_ends": self.get_row_ends()
+		})
+		arrays.update(self.prefix_index)
+		return arrays
+
+
+	def nbytes(self):
+		"""
+		Returns the number of bytes held by the arrays of this table
+		"""
+		return sum(array.nbytes for array in self.arrays().values())
+
+
+	def vocab_nbytes(self):
+		"""
+		Returns the number of bytes held by the vocabulary of this table: the
+		token strings, the vocab list and the token_ids dict, or the arrays of
+		a MappedVocabulary
+		"""
+		if isinstance(self.vocab, MappedVocabulary):
+			return self.vocab.nbytes()
+		return sys.getsizeof(self.vocab) + sys.getsizeof(self.token_ids) + sum(map(sys.getsizeof, self.vocab))
+
+
+	def pack(self, tokens):
+		"""
+		Packs a sequence of tokens into an integer key.
+
+		Returns:
+			key: the packed key, or None if a token is not in the vocabulary
+		"""
+		key = 0
+		for token in tokens:
+			token_id = self.token_ids.get(token)
+			if token_id is None:
+				return None
+			key = key * self.base + token_id
+		return key
+
+
+	def unpack(self, key, length):
+		"""
+		Unpacks an integer key into a list of `length` tokens
+		"""
+		tokens = []
+		for i in range(length):
+			key, token_id = divmod(key, self.base)
+			tokens.append(self.vocab[token_id])
+		tokens.reverse()
+		return tokens
+
+
+	def find_row(self, key):
+		"""
+		Returns the row of the context with the given packed key, or -1 if there is none
+		"""
+		if key is None:
+			return -1
+		row = int(np.searchsorted(self.context_keys, key))
+		if row == len(self.context_keys) or self.context_keys[row] != key:
+			return -1
+		return row
+
+
+	def sample_row(self, row, random_float):
+		"""
+		Draws the id of a follower of the given row, with probability proportional to its count
+
+		Parameters:
+			row: a row returned by find_row
+			random_float: a float in [0, 1)
+		"""
+		lo, hi = self.offsets[row], self.offsets[row + 1]
+		base = int(self.cumulative[lo - 1]) if lo > 0 else 0
+		target = base + int(random_float * (int(self.cumulative[hi - 1]) - base))
+		return int(self.next_ids[np.searchsorted(self.cumulative, target, side="right")])
+
+
+	def sample_start(self, random_float):
+		"""
+		Draws the `order` tokens that start a sentence, the ("\n",) special case of SLM.
+		Raises a KeyError like SLM.get_sampler if no sentence start is left, e.g. after pruning
+		"""
+		if len(self.start_keys) == 0:
+			raise KeyError("ERROR: the key \"\n\" does not exist in the corpus.")
+		total = int(self.start_cumulative[-1])
+		idx = np.searchsorted(self.start_cumulative, int(random_float * total), side="right")
+		return self.unpack(int(self.start_keys[idx]), self.order)
+
+
+	def walk(self, context, steps, random_float):
+		"""
+		Generates `steps` tokens following the given context.
+
+		Parameters:
+			context: a list of `order` tokens
+			steps: the number of tokens to generate
+			random_float: a function returning floats in [0, 1), e.g. random.random
+
+		Returns:
+			tokens: the generated tokens, or None if the walk reaches a context that
+					is not in the table
+		"""
+		key = self.pack(context)
+		tokens = []
+		for i in range(steps):
+			row = self.find_row(key)
+			if row < 0:
+				return None
+			next_id = self.sample_row(row, random_float())
+			tokens.append(self.vocab[next_id])
+			key = (key % self.high) * self.base + next_id
+		return tokens
+
+
+	def get_prefix_index(self):
+		"""
+		Returns the index of the rows by the prefixes of their contexts, for 
+		every prefix of 1 to order - 1 tokens, as a dict of arrays:
+			prefix_keys: int64 (p,), the packed prefixes of every length, sorted within a length
+			prefix_rows: int64 (p, 2), the range (lo, hi) of the rows whose context starts with the prefix
+			prefix_bounds: int64 (order,), the prefixes of length l are prefix_keys[prefix_bounds[l-1]:prefix_bounds[l]]
+		The context keys are sorted, so the contexts that share a prefix are 
+		contiguous rows. Built on first use, see prefix_rows
+		"""
+		if self.prefix_index is None:
+			keys, rows, bounds = [np.empty(0, dtype=np.int64)], [np.empty((0, 2), dtype=np.int64)], [0]
+			for length in range(1, self.order):
+				prefixes = self.context_keys // self.base ** (self.order - length)
+				unique, starts, sizes = np.unique(prefixes, return_index=True, return_counts=True)
+				keys.append(unique)
+				rows.append(np.stack((starts, starts + sizes), axis=1))
+				bounds.append(bounds[-1] + len(unique))
+			self.prefix_index = {
+				"prefix_keys": np.concatenate(keys).astype(np.int64),
+				"prefix_rows": np.concatenate(rows).astype(np.int64),
+				"prefix_bounds": np.array(bounds, dtype=np.int64)
+			}
+		return self.prefix_index
+
+
+	def sample_prefix(self, prefix, random_float):
+		"""
+		Draws a context that starts with the given tokens, with probability 
+		proportional to how often it was seen
+
+		Parameters:
+			prefix: a list of 1 to order - 1 tokens
+			random_float: a float in [0, 1)
+
+		Returns:
+			context: a list of `order` tokens, or None if no context starts with prefix
+		"""
+		rows = self.prefix_rows(prefix)
+		if rows is None:
+			return None
+		row_ends = self.get_row_ends()
+		lo, hi = rows
+		base = int(row_ends[lo - 1]) if lo > 0 else 0
+		target = base + int(random_float * (int(row_ends[hi - 1]) - base))
+		row = lo + int(np.searchsorted(row_ends[lo:hi], target, side="right"))
+		return self.unpack(int(self.context_keys[row]), self.order)
+
+
+	def prefix_rows(self, prefix):
+		"""
+		Returns the range (lo, hi) of the rows whose context starts with the 
+		given 1 to order - 1 tokens, None if there is none (see get_prefix_index)
+		"""
+		key = self.pack(prefix)
+		if key is None:
+			return None
+		index = self.get_prefix_index()
+		lo, hi = index["prefix_bounds"][len(prefix) - 1:len(prefix) + 1].tolist()
+		at = lo + int(np.searchsorted(index["prefix_keys"][lo:hi], key))
+		if at == hi or index["prefix_keys"][at] != key:
+			return None
+		return tuple(index["prefix_rows"][at].tolist())
+
+
+	def get_row_ends(self):
+		"""
+		Returns the running total of the follower counts at the end of every row. Built on first use
+		"""
+		if self.row_ends is None:
+			self.row_ends = self.cumulative[self.offsets[1:] - 1]
+		return self.row_ends
+
+
+	def row_totals(self, lo, hi):
+		"""
+		Returns the total follower count of every row from lo to hi
+		"""
+		row_ends = self.get_row_ends()
+		return np.diff(row_ends[lo:hi], prepend=row_ends[lo - 1] if lo > 0 else 0)
+
+
+	def get_edge_targets(self):
+		"""
+		Returns, for every follower, the row of the context it leads to (the 
+		context shifted by one with the follower appended), -1 if that context 
+		is not in the table. Lets a walk move from row to row without searching
+		for the next context. Built on first use
+		"""
+		if self.edge_targets is None:
+			rows = np.repeat(np.arange(len(self.context_keys), dtype=np.int64), np.diff(self.offsets))
+			keys = (self.context_keys[rows] % self.high) * self.base + self.next_ids
+			self.edge_targets = self.find_rows(keys)
+		return self.edge_targets
+
+
+	def find_rows(self, keys):
+		"""
+		Returns the row of every packed key in an int64 array, -1 where there is none
+		"""
+		if len(self.context_keys) == 0:
+			return np.full(len(keys), -1, dtype=np.int64)
+		rows = np.minimum(np.searchsorted(self.context_keys, keys), len(self.context_keys) - 1)
+		return np.where(self.context_keys[rows] == keys, rows, -1)
+
+
+	def sample_edges(self, rows, rng):
+		"""
+		Draws one follower for every row in rows at once
+
+		Parameters:
+			rows: an int64 array of rows returned by find_row
+			rng: a numpy random Generator
+
+		Returns:
+			edges: an int64 array with the index (into next_ids) of the drawn follower of every row
+		"""
+		lo, hi = self.offsets[rows], self.offsets[rows + 1]
+		base = np.where(lo > 0, self.cumulative[lo - 1], 0)
+		totals = self.cumulative[hi - 1] - base
+		targets = base + (rng.random(len(rows)) * totals).astype(np.int64)
+		return np.searchsorted(self.cumulative, targets, side="right")
+
+
+	def walk_batch(self, n, length, rng):
+		"""
+		Generates n sequences of token ids in lockstep, one array operation per
+		step for all the chains. Every chain starts like SLM.generate without a 
+		prompt, from `order` tokens that follow a "\n".
+
+		Parameters:
+			n: the number of chains
+			length: the number of tokens of every chain (at least `order`)
+			rng: a numpy random Generator
+
+		Returns:
+			(ids, alive): an (n, length) int64 array of token ids, and a boolean 
+						  array that is False for the chains that reached a 
+						  context not in the table (their ids are incomplete)
+		"""
+		order, length = self.order, max(length, self.order)
+		ids = np.zeros((n, length), dtype=np.int64)
+		alive = np.ones(n, dtype=bool)
+
+		if order > 1:
+			# no sentence start left (e.g. after pruning): every chain is dead
+			if len(self.start_keys) == 0:
+				return ids, ~alive
+			total = int(self.start_cumulative[-1])
+			starts = np.searchsorted(self.start_cumulative, rng.integers(0, total, n), side="right")
+			keys = self.start_keys[starts]
+		else:
+			# order 1: the start is a single token drawn from the row of "\n"
+			row = self.find_row(self.pack(["\n"]))
+			if row < 0:
+				return ids, ~alive
+			keys = self.next_ids[self.sample_edges(np.full(n, row, dtype=np.int64), rng)].astype(np.int64)
+		for j in range(order):
+			ids[:, j] = keys // self.base ** (order - 1 - j) % self.base
+
+		edge_targets = self.get_edge_targets()
+		chains, rows = np.arange(n), self.find_rows(keys)
+		for step in range(order, length):
+			found = rows >= 0
+			if not found.all():
+				alive[chains[~found]] = False
+				chains, rows = chains[found], rows[found]
+			edges = self.sample_edges(rows, rng)
+			ids[chains, step] = self.next_ids[edges]
+			rows = edge_targets[edges]
+		return ids, alive
+
+
+	def probability(self, context, token):
+		"""
+		Returns the probability that token follows the given context, 0.0 if unseen
+		"""
+		row = self.find_row(self.pack(context))
+		token_id = self.token_ids.get(token)
+		if row < 0 or token_id is None:
+			return 0.0
+		lo, hi = int(self.offsets[row]), int(self.offsets[row + 1])
+		idx = lo + int(np.searchsorted(self.next_ids[lo:hi], token_id))
+		if idx == hi or self.next_ids[idx] != token_id:
+			return 0.0
+		base = int(self.cumulative[lo - 1]) if lo > 0 else 0
+		before = int(self.cumulative[idx - 1]) if idx > 0 else 0
+		return (int(self.cumulative[idx]) - before) / (int(self.cumulative[hi - 1]) - base)
+
+
+	def encode(self, tokens):
+		"""
+		Encodes a list of tokens as an int64 array of ids, -1 for tokens outside the vocabulary
+		"""
+		return np.fromiter(map(self.token_ids.get, tokens, itertools.repeat(-1)), dtype=np.int64, count=len(tokens))
 
 
-	def split_with_character(self, string):
+	def get_edge_keys(self):
 		"""
-		Takes in a string and splits it into tokens by characters. 
-		Tabs, newlines, and punctuations count as tokens
-		
-		Parameters:
-			string: the string to be tokenized
-			
-		Returns:
-			lst: the list of tokens
+		Returns row * base + next_id for every follower. Rows are sorted and 
+		next_ids are sorted within a row, so the array is sorted and a 
+		(row, next_id) pair can be found with one searchsorted. Built on first use
 		"""
-		lst = []
+		if self.edge_keys is None:
+			rows = np.repeat(np.arange(len(self.context_keys), dtype=np.int64), np.diff(self.offsets))
+			self.edge_keys = rows * self.base + self.next_ids
+		return self.edge_keys
 
-		string = string.lower()
-		string_length = len(string) 
 
-		for i in range(string_length):
-			# append \[smth] operation to the lst and skip one index
-			if string[i] == "\\":
-				lst.append(string[i] + string[i + 1]) # for \t, \n, etc.
-				i+=1
-			# skip when hit space
-			elif string[i] == " ": 
-				i+=1
-			# append current character to the lst
-			else:
-				lst.append(string[i]) # append symbol
+	def score_ids(self, ids):
+		"""
+		Scores every position of an encoded text in one batch of array operations.
 
-		return lst
+		Parameters:
+			ids: an int64 array of token ids, as returned by encode
 
-		
-	def populate_transitions_from_lst(self, lst, p):
+		Returns:
+			scores: a float64 array where scores[i] is the probability that ids[i] follows
+					ids[i-order:i], 0.0 for the first `order` positions and for unseen ngrams
 		"""
-		Helper function for train.
-		Populates self.transitions dictionary from a lst of strings that is 
-		ordered based on their appearance in the corpus.
-		
-		Parameters:
-			lst: a list of tokens
-			p: a number between 0 and 100, the percentage of the lst to be trained on from the beginning
+		order = self.order
+		scores = np.zeros(len(ids))
+		if len(ids) <= order or len(self.context_keys) == 0:
+			return scores
+
+		powers = self.base ** np.arange(order - 1, -1, -1, dtype=np.int64)
+		windows = np.lib.stride_tricks.sliding_window_view(ids[:-1], order)
+		nexts = ids[order:]
+		valid = (windows >= 0).all(axis=1) & (nexts >= 0)
+		keys = windows @ powers
+
+		rows = np.minimum(np.searchsorted(self.context_keys, keys), len(self.context_keys) - 1)
+		valid &= self.context_keys[rows] == keys
+
+		edge_keys = self.get_edge_keys()
+		targets = rows * self.base + nexts
+		edges = np.minimum(np.searchsorted(edge_keys, targets), len(edge_keys) - 1)
+		valid &= edge_keys[edges] == targets
+
+		rows, edges = rows[valid], edges[valid]
+		cumulative = self.cumulative
+		lo, hi = self.offsets[rows], self.offsets[rows + 1]
+		row_base = np.where(lo > 0, cumulative[lo - 1], 0)
+		edge_base = np.where(edges > 0, cumulative[edges - 1], 0)
+		scores[order:][valid] = (cumulative[edges] - edge_base) / (cumulative[hi - 1] - row_base)
+		return scores
+
+
+	def to_counts(self):
 		"""
-		if len(lst) < self.order:
-			sys.exit("ERROR: The corpus is smaller than the order." +\
-			"\nLower the order or change to a bigger corpus")
-		
-		# to ensure that there is at least one \n in the lst
-		lst.insert(0, "\n") 
+		Returns the transitions as a dict in the format of SLM.counts
+		"""
+		counts = {}
+		if len(self.start_keys):
+			start_counts = np.diff(self.start_cumulative, prepend=0).tolist()
+			counts[("\n",)] = {tuple(self.unpack(key, self.order)): count 
+				for key, count in zip(self.start_keys.tolist(), start_counts)}
 
-		t = {} # intermideate dict for transitions later
-		ngram_list = ["placeholder"] # the current n-gram
-		ngram = () # initialize an empty tuple version of ngram_list
+		follower_counts = np.diff(self.cumulative, prepend=0).tolist()
+		next_ids, offsets = self.next_ids.tolist(), self.offsets.tolist()
+		for row, key in enumerate(self.context_keys.tolist()):
+			counts[tuple(self.unpack(key, self.order))] = {(self.vocab[next_ids[j]],): follower_counts[j] 
+				for j in range(offsets[row], offsets[row + 1])}
+		return counts
 
-		for i in range(self.order-1):
-			ngram_list.append(lst[i]) 
-		
-		train_till = int(len(lst)/100*p)
-		# fill up t below
-		for i in range(self.order, train_till): 
-			# new ngram
-			ngram_list.pop(0)
-			ngram_list.append(lst[i-1])
-			ngram = tuple(ngram_list) 
 
-			# Special case for new lines
-			if ngram_list[0] == "\n":
-				tmp_ngram = tuple("\n")
-				words_after_gram = []
-				for j in range(1, len(ngram_list)):
-					words_after_gram.append(ngram_list[j]) 
-				words_after_gram.append(lst[i])
-				
-				if tmp_ngram not in t:
-					t[tmp_ngram] = [[],[]]
-				
-				if words_after_gram in t[tmp_ngram][0]:
-					idx = t[tmp_ngram][0].index(words_after_gram)
-					t[tmp_ngram][1][idx] += 1
-				else:
-					t[tmp_ngram][0].append(words_after_gram)
-					t[tmp_ngram][1].append(1)
-			
-			# Normal cases  
-			if ngram not in t:
-				t[ngram] = [[],[]]
-
-			word_after_gram = [lst[i]]
-			if word_after_gram in t[ngram][0]:
-				idx = t[ngram][0].index(word_after_gram)
-				t[ngram][1][idx] += 1
-			else:
-				t[ngram][0].append(word_after_gram)
-				t[ngram][1].append(1)
-			
-		# fill up transitions from t, below
-		for key in t:
-			info = t[key] # ex, [[w1, w2, w3], [1,3,2]]
-			value = [] # value in transitions, to be filled
-			counts = sum(info[1])
-			lo = 0.0
-			for idx in range(len(info[0])):
-				hi = lo + info[1][idx]/counts
-				tup = (info[0][idx], (lo, hi))
-				value.append(tup)
-				lo = hi
-			# value should be filled by now
-			self.transitions[key] = value
-
-
-	def train(self, p=100, chunck_size=1000):
+class DenseTransitions(PackedTransitions):
+	"""
+	Class DenseTransitions is the dense form of an SLM's transitions, for 
+	models with a small vocabulary such as character level ones.
+
+	Every context seen in the corpus is a row of a (contexts, vocab) matrix 
+	that holds the running total of its follower counts, so sampling and 
+	scoring are direct array lookups instead of searches over the followers:
+		context_keys: sorted int64 (n,), packed keys as in PackedTransitions
+		cumulative: int64 (n, len(vocab)), running total of the follower counts
+					over the whole matrix in row-major order, like the 
+					cumulative of PackedTransitions with every token a follower
+		start_keys, start_cumulative: as in PackedTransitions
+	When len(vocab) ** order is small enough (see DENSE_INDEX_LIMIT) a context 
+	key is also mapped to its row by a direct index instead of a binary search.
+	Everything else is inherited from PackedTransitions.
+	"""
+
+	def __init__(self, vocab, order, arrays):
 		"""
-		Trains a model given the percentage to train.
-		The chunk size can be provided to create a z_score_estimator out of this
+		Intializer of DenseTransitions
 
 		Parameters:
-			p (optional): a number between 0 and 100 representing how much of 
-						  the corpus should be trained from the beginning
-			chunck_size (optional): the chunk size for the z score estimator
+			vocab: a list of tokens, the position of a token is its id
+			order: the order of the SLM the transitions belong to
+			arrays: a dict of the arrays listed above, may be views over a mapped file
 		"""
-		# if token_list is empty, calculate and record the tokenized_list
-		if not self.tokenized_list:
-			file = open(self.corpus, "r")
+		# a dense row has no follower list, every token of the vocabulary follows it
+		super().__init__(vocab, order, dict(arrays, offsets=None, next_ids=None))
+		# the running total of the follower counts at the end of every row, see sample_prefix
+		self.row_ends = self.cumulative[:, -1]
+		self.row_starts = self.row_ends - np.diff(self.row_ends, prepend=0)
+		# the PackedTransitions form of the table, built for walk_batch
+		self.sparse = None
 
-			# tokenize each line of the file based on the level parameter
-			if self.level == "word":
-				corpus_string = (" ").join(file)
-				self.tokenized_list = self.split_with_word(corpus_string)
+		self.row_index = None
+		if self.base ** order <= DENSE_INDEX_LIMIT:
+			self.row_index = np.full(self.base ** order, -1, dtype=np.int32)
+			self.row_index[self.context_keys] = np.arange(len(self.context_keys), dtype=np.int32)
 
-			elif self.level == "character":
-				corpus_string = (" ").join(file)
-				self.tokenized_list = self.split_with_character(corpus_string)
 
-			else:
-				sys.exit("ERROR: Invalid level parameter: " + self.level + \
-					"\nlevel should either be \"word\" or \"character\"")
+	def arrays(self):
+		"""
+		Returns the arrays of this table as a dict, in the form __init__ takes them
+		"""
+		return {
+			"context_keys": self.context_keys,
+			"cumulative": self.cumulative,
+			"start_keys": self.start_keys,
+			"start_cumulative": self.start_cumulative
+		}
 
-			file.close()
 
-		self.populate_transitions_from_lst(self.tokenized_list, p)
+	def find_row(self, key):
+		"""
+		Returns the row of the context with the given packed key, or -1 if there is none
+		"""
+		if key is None:
+			return -1
+		if self.row_index is not None:
+			return int(self.row_index[key])
+		return super().find_row(key)
 
-		if p < 100:
-			self.z_score_estimator(chunck_size, 100 - p)
 
+	def find_rows(self, keys):
+		"""
+		Returns the row of every packed key in an int64 array, -1 where there is none
+		"""
+		if self.row_index is not None:
+			return self.row_index[keys].astype(np.int64)
+		return super().find_rows(keys)
 
-	def find_next(self, key):
+
+	def sample_row(self, row, random_float):
 		"""
-		Helper function for generate()
-		Probabilistically finds the next word from transitions, given key
-		
+		Draws the id of a follower of the given row, with probability proportional to its count
+
 		Parameters:
-			key: a tuple of tokens
+			row: a row returned by find_row
+			random_float: a float in [0, 1)
 		"""
-		try:
-			words = []
-			random_float = random.random()
-			candidates = self.transitions[tuple(key)]
-			for i in range(len(candidates)):
-				bounds = candidates[i][1]
-				if random_float < bounds[1]:
-					words = (candidates[i][0])
-					break
-			return words
-		# when key is not a valid ngram (key does not exist in transitions)
-		except KeyError:
-			raise KeyError("ERROR: the key \"{}\" does not exist in the corpus.".format((" ").join(key)))
+		base = int(self.row_starts[row])
+		target = base + int(random_float * (int(self.row_ends[row]) - base))
+		return int(np.searchsorted(self.cumulative[row], target, side="right"))
 
-	
-	def eliminate_white_space_on_symbol(self, string):
+
+	def walk_batch(self, n, length, rng):
 		"""
-		Helper function for generate()
-		Removes whitespaces that come before symbols
+		Generates n sequences of token ids in lockstep, see PackedTransitions.walk_batch.
+		Runs on the sparse form of the table (see to_packed), where every 
+		follower knows the row it leads to, so a step needs no context search
 		"""
-		return re.sub("\s+(?=[\W])", "", string)
+		if self.sparse is None:
+			self.sparse = self.to_packed()
+		return self.sparse.walk_batch(n, length, rng)
 
 
-	def generate(self, length, prompt="\n"):
-		""""
-		Generates text with the size of a given length based on the trained model. 
+	def probability(self, context, token):
+		"""
+		Returns the probability that token follows the given context, 0.0 if unseen
+		"""
+		row = self.find_row(self.pack(context))
+		token_id = self.token_ids.get(token)
+		if row < 0 or token_id is None:
+			return 0.0
+		base = int(self.row_starts[row])
+		before = int(self.cumulative[row, token_id - 1]) if token_id > 0 else base
+		return (int(self.cumulative[row, token_id]) - before) / (int(self.row_ends[row]) - base)
 
-		The prompt is an optional starting word(s) for the generated text. The 
-		size of the prompt has to be greater than or equal to the order of
-		the class, or else the function will use a random text as a starting
-		prompt
 
-		Parameters:
-			length: the length of the text to be generated (measured by tokens)
-			prompt (optinal): text to start off
+	def score_ids(self, ids):
+		"""
+		Scores every position of an encoded text in one batch of array operations,
+		see PackedTransitions.score_ids
+		"""
+		order = self.order
+		scores = np.zeros(len(ids))
+		if len(ids) <= order or len(self.context_keys) == 0:
+			return scores
+
+		powers = self.base ** np.arange(order - 1, -1, -1, dtype=np.int64)
+		windows = np.lib.stride_tricks.sliding_window_view(ids[:-1], order)
+		nexts = ids[order:]
+		valid = (windows >= 0).all(axis=1) & (nexts >= 0)
+		rows = self.find_rows(np.where(valid, windows @ powers, 0))
+		valid &= rows >= 0
+
+		rows, nexts = rows[valid], nexts[valid]
+		base = self.row_starts[rows]
+		before = np.where(nexts > 0, self.cumulative[rows, np.maximum(nexts - 1, 0)], base)
+		scores[order:][valid] = (self.cumulative[rows, nexts] - before) / (self.row_ends[rows] - base)
+		return scores
+
+
+	def to_packed(self):
+		"""
+		Returns the same transitions as a PackedTransitions, e.g. to save them
+		"""
+		counts = np.diff(self.cumulative.reshape(-1), prepend=0).reshape(self.cumulative.shape)
+		rows, next_ids = np.nonzero(counts)
+		arrays = {
+			"context_keys": self.context_keys,
+			"offsets": np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=len(self.context_keys))))).astype(np.int64),
+			"next_ids": next_ids.astype(np.int32),
+			"cumulative": np.cumsum(counts[rows, next_ids]),
+			"start_keys": self.start_keys,
+			"start_cumulative": self.start_cumulative
+		}
+		return PackedTransitions(self.vocab, self.order, arrays)
 
-		Returns:    
-			result: generated string or None if prompt is invalid or generate 
-					runs into an edge case where focused_phrase is not in the 
-					transitions dict
+
+	def to_counts(self):
 		"""
-		tokenized_prompt = [] 
-		if self.level == "word":
-			tokenized_prompt = self.split_with_word(prompt)
+		Returns the transitions as a dict in the format of SLM.counts
+		"""
+		return self.to_packed().to_counts()
 
-		elif self.level == "character":
-			tokenized_prompt = self.split_with_character(prompt)
 
-		else:
-			sys.exit("ERROR: Invalid level parameter: " + self.level + \
-				"\nlevel should either be \"word\" or \"character\"")
+def pack_transitions(counts, order):
+	"""
+	Builds a PackedTransitions from the counts of an SLM
 
-		# Generate the starter of the sentence 
-		starter = []
-		if len(tokenized_prompt) < self.order:
-			# print("NOTICE: The prompt is too short or it is not provided, we will generate a sentence randomly.\n")
-			try:
-				starter = list.copy(self.find_next("\n"))
-			except KeyError as err:
-				# print(err) # should never reach this except
-				return None
+	Parameters:
+		counts: a dict of ngram tuple -> {tuple of following tokens: count}, as in SLM.counts
+		order: the order of the SLM
+
+	Returns:
+		packed: the PackedTransitions
+	"""
+	vocab = {}
+	contexts, edge_rows, edge_next, edge_counts = [], [], [], []
+	start_followers, start_counts = [], []
+	for key, followers in counts.items():
+		key_ids = [vocab.setdefault(token, len(vocab)) for token in key]
+		if len(key) == order:
+			row = len(contexts)
+			contexts.append(key_ids)
+			for words, count in followers.items():
+				edge_rows.append(row)
+				edge_next.append(vocab.setdefault(words[0], len(vocab)))
+				edge_counts.append(count)
 		else:
-			starting_point = len(tokenized_prompt) - self.order
-			for i in range(self.order):
-				starter.append(tokenized_prompt[starting_point + i])
-		
-		# Generate the rest of the sentence
-		next_word = []
-		focused_phrase = starter
-		result = ""
+			# the ("\n",) special case, followers are `order` tokens long
+			for words, count in followers.items():
+				start_followers.append([vocab.setdefault(word, len(vocab)) for word in words])
+				start_counts.append(count)
+
+	base = max(len(vocab), 1)
+	if base ** order >= 2 ** 63:
+		sys.exit("ERROR: The vocabulary is too large to pack contexts of order {} into 64 bits.".format(order))
+	powers = np.array([base ** (order - 1 - i) for i in range(order)], dtype=np.int64)
+
+	keys = np.array(contexts, dtype=np.int64).reshape(-1, order) @ powers
+	rank = np.empty(len(keys), dtype=np.int64)
+	rank[np.argsort(keys)] = np.arange(len(keys))
+	edge_rank = rank[np.array(edge_rows, dtype=np.int64)]
+	edge_next = np.array(edge_next, dtype=np.int32)
+	edge_order = np.lexsort((edge_next, edge_rank))
+
+	start_keys = np.array(start_followers, dtype=np.int64).reshape(-1, order) @ powers
+	start_order = np.argsort(start_keys)
+
+	arrays = {
+		"context_keys": np.sort(keys),
+		"offsets": np.concatenate(([0], np.cumsum(np.bincount(edge_rank, minlength=len(keys))))).astype(np.int64),
+		"next_ids": edge_next[edge_order],
+		"cumulative": np.cumsum(np.array(edge_counts, dtype=np.int64)[edge_order]),
+		"start_keys": start_keys[start_order],
+		"start_cumulative": np.cumsum(np.array(start_counts, dtype=np.int64)[start_order])
+	}
+	return PackedTransitions(sorted(vocab, key=vocab.get), order, arrays)
+
+
+def vocabulary_arrays(vocab):
+	"""
+	Builds the arrays of a MappedVocabulary
 
-		for j in range(len(starter)):
-				result += starter[j] + " "
-		
-		for k in range(self.order, length):
-			try:
-				next_word = self.find_next(focused_phrase)
-			# catch edge case when focused_phrase is not in the corpus
-			except KeyError as err:
-				# print(err)
-				return None
-			for word in range(len(next_word)):
-				result += next_word[word] + " "
-			focused_phrase.pop(0)
-			focused_phrase.extend(next_word)
+	Parameters:
+		vocab: a sequence of tokens, the position of a token is its id
 
-		result = self.eliminate_white_space_on_symbol(result)
+	Returns:
+		arrays: a dict with the vocab_blob, vocab_offsets and vocab_slots arrays
+	"""
+	data = [token.encode("utf-8") for token in vocab]
+	offsets = np.zeros(len(data) + 1, dtype=np.int64)
+	offsets[1:] = np.cumsum([len(token) for token in data])
+	# at most half of the slots are used, so probes stay short
+	slots = np.full(1 << (2 * len(data)).bit_length(), -1, dtype=np.int32)
+	mask = len(slots) - 1
+	for token_id, token in enumerate(data):
+		slot = zlib.crc32(token) & mask
+		while slots[slot] >= 0:
+			slot = (slot + 1) & mask
+		slots[slot] = token_id
+	return {
+		"vocab_blob": np.frombuffer(b"".join(data), dtype=np.uint8),
+		"vocab_offsets": offsets,
+		"vocab_slots": slots
+	}
+
+
+def fits_packed_keys(vocab_size, order):
+	"""
+	Returns whether contexts of `order` tokens out of vocab_size tokens can be 
+	packed into the int64 keys of a PackedTransitions
+	"""
+	return max(vocab_size, 1) ** order < 2 ** 63
 
-		return result
 
+def count_vocabulary(counts):
+	"""
+	Returns the number of distinct tokens in the contexts and followers of the counts of an SLM
+	"""
+	vocab = set()
+	for key, followers in counts.items():
+		vocab.update(key)
+		for words in followers:
+			vocab.update(words)
+	return len(vocab)
 
-	def get_likelihood(self, tokenized_text):
-		"""
-		Gets the likelihood that a given tokenized_text is generated by this model.
-		
-		Parameters: 
-			tokenized_text: the text as a list of tokens
-		Returns:
-			raw_score: the sum of probability of all the grams being generated by this model
-		"""
-		# calculate raw_score and likelihood of every sentence
-		ngram_list = ["placeholder"]
-		raw_score = 0.0
-		for i in range(self.order-1):
-			ngram_list.append(tokenized_text[i])
-		for i in range(self.order, len(tokenized_text)): 
-			# new ngram
-			ngram_list.pop(0)
-			ngram_list.append(tokenized_text[i-1])
-			ngram = tuple(ngram_list)
-			curr = tokenized_text[i]
-
-			if ngram in self.transitions:
-				# find if the current word is in transitions's value
-				values = self.transitions[ngram]
-				for v in values: 
-					#each v is a tuple, ex, ([“brown”], (0.0, 0.65))
-					if v[0][0] == curr:
-						score = v[1][1] - v[1][0]
-						raw_score += score
-		return raw_score
 
+def densify_transitions(packed):
+	"""
+	Builds a DenseTransitions with the same transitions as a PackedTransitions
 
-	def z_score_estimator(self, chunk_size, test_size):
-		"""
-		Calculates the mean and the standard_deviation of the likihoods from the test
-		portion of the model's tokenized_list by splitting the test portion into chunks
+	Parameters:
+		packed: the PackedTransitions
 
-		Parameters:
-			chunk_size: the numbers of words in each chunk
-			test_size: the size of the test portion (out of a 100)
-		"""
-		tokenized_list_length = len(self.tokenized_list)
-		# iterate through the chunks
-		start = int(tokenized_list_length * (100 - test_size) / 100) 
-		
-		chunk_raw_scores = []
-		if (start + self.order > tokenized_list_length):
-			sys.exit("ERROR: The text to be estimated is too small")
-		
-		while (start < tokenized_list_length):
+	Returns:
+		dense: the DenseTransitions
+	"""
+	check_dense_size(len(packed.context_keys), packed.base)
+	counts = np.zeros((len(packed.context_keys), packed.base), dtype=np.int64)
+	rows = np.repeat(np.arange(len(packed.context_keys)), np.diff(packed.offsets))
+	counts[rows, packed.next_ids] = np.diff(packed.cumulative, prepend=0)
+	arrays = {
+		"context_keys": packed.context_keys,
+		"cumulative": np.cumsum(counts).reshape(counts.shape),
+		"start_keys": packed.start_keys,
+		"start_cumulative": packed.start_cumulative
+	}
+	return DenseTransitions(packed.vocab, packed.order, arrays)
+
+
+def count_dense_transitions(tokens, order):
+	"""
+	Builds a DenseTransitions straight from a list of tokens, counting the 
+	transitions the same way as SLM.count_transitions but as one histogram 
+	of array operations
 
-			end = start + chunk_size
-		
-			if end > tokenized_list_length - chunk_size: 
-				# should just extend to the end
-				end = len(self.tokenized_list)
-			
-			# normalizes the likelihood by dividing with the size
-			likelihood_score = self.get_likelihood(self.tokenized_list[start:end]) / (end - start)  
-			chunk_raw_scores.append(likelihood_score)
-			start = end # increments chunk_size at a time
+	Parameters:
+		tokens: a list of tokens ordered based on their appearance in the corpus
+		order: the order of the SLM
 
-		# cal sd and mean
-		self.standard_deviation = statistics.stdev(chunk_raw_scores)
-		self.mean = sum(chunk_raw_scores) / len(chunk_raw_scores)
+	Returns:
+		dense: the DenseTransitions
+	"""
+	# ids in order of first appearance, like pack_transitions
+	vocab = list(dict.fromkeys(tokens))
+	base = max(len(vocab), 1)
+	if base ** order >= 2 ** 63:
+		sys.exit("ERROR: The vocabulary is too large to pack contexts of order {} into 64 bits.".format(order))
+	token_ids = {token: i for i, token in enumerate(vocab)}
+	ids = np.fromiter(map(token_ids.__getitem__, tokens), dtype=np.int64, count=len(tokens))
+	powers = base ** np.arange(order - 1, -1, -1, dtype=np.int64)
+
+	# every window of `order` tokens that is followed by a token
+	keys = np.lib.stride_tricks.sliding_window_view(ids[:-1], order) @ powers
+	nexts = ids[order:]
+	context_keys, rows = np.unique(keys, return_inverse=True)
+	check_dense_size(len(context_keys), base)
+	counts = np.bincount(rows.ravel() * base + nexts, minlength=len(context_keys) * base).reshape(-1, base)
+
+	new_line = vocab.index("\n") if "\n" in vocab else -1
+	if order > 1:
+		# the ("\n",) special case: the `order` tokens after every "\n" that starts a window
+		starts = np.flatnonzero(ids[:-order] == new_line)
+		start_windows = np.lib.stride_tricks.sliding_window_view(ids[1:], order)[starts]
+		start_keys, start_counts = np.unique(start_windows @ powers, return_counts=True)
+	else:
+		start_keys, start_counts = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+		if new_line >= 0:
+			# an SLM of order 1 counts the followers of "\n" twice
+			counts[context_keys == new_line] *= 2
+
+	arrays = {
+		"context_keys": context_keys,
+		"cumulative": np.cumsum(counts).reshape(counts.shape),
+		"start_keys": start_keys,
+		"start_cumulative": np.cumsum(start_counts)
+	}
+	return DenseTransitions(vocab, order, arrays)
+
+
+def check_dense_size(contexts, base):
+	"""
+	Helper function that exits if a dense table of contexts rows would be too large
+	"""
+	if contexts * base > DENSE_CELL_LIMIT:
+		sys.exit("ERROR: {} contexts of {} tokens are too many for dense transitions.".format(contexts, base) +\
+			"\nUse compact() instead")
 
 
-	def estimate(self, input_text):
-		"""
-		Finds the z_score of the input_text given the z score estimator
+def spill_ngram_run(ids, order, path):
+	"""
+	Counts the ngrams of `order` + 1 tokens of an array of token ids and saves
+	them to path as a run for merge_ngram_runs: an int64 .npy array with one
+	row per distinct ngram, its ids followed by its count, sorted by the ids
 
-		Parameters:
-			input_text: the string that is the input text
+	Parameters:
+		ids: an int64 array of token ids
+		order: the order of the SLM
+		path: the path of the .npy file to write
+	"""
+	windows = np.lib.stride_tricks.sliding_window_view(ids, order + 1)
+	windows = windows[np.lexsort(windows.T[::-1])]
+	# the first row of every group of equal ngrams
+	first = np.concatenate(([True], (windows[1:] != windows[:-1]).any(axis=1)))
+	starts = np.flatnonzero(first)
+	counts = np.diff(np.append(starts, len(windows)))
+	np.save(path, np.column_stack((windows[starts], counts)))
 
-		Returns:
-			input_z_score: the z_score of the input text estimated by the z_score_estimator of this model
-		"""
-		tokenized_input = [];
 
-		tokenized_input = self.split_with_word(input_text)
+def read_ngram_run(path, block_rows=1 << 16):
+	"""
+	Helper function for merge_ngram_runs
+	Yields the rows of a run written by spill_ngram_run as lists, reading 
+	block_rows rows of the memory mapped file at a time
+	"""
+	run = np.load(path, mmap_mode="r")
+	for start in range(0, len(run), block_rows):
+		yield from run[start:start + block_rows].tolist()
 
-		# calculate likelihood and zscore
-		input_likelihood = self.get_likelihood(tokenized_input) / len(tokenized_input)
-		input_z_score = (input_likelihood - self.mean) / self.standard_deviation
 
-		return input_z_score
-		
+def merge_ngram_runs(paths, vocab, order):
+	"""
+	Merges the runs written by spill_ngram_run into a PackedTransitions, the 
+	same as pack_transitions on the counts of all the runs added up. The runs
+	are sorted by ids, which are the digits of the packed keys, so one 
+	heapq.merge pass yields the contexts and their followers in the order of
+	the packed arrays.
+
+	Parameters:
+		paths: a list of the paths of the runs
+		vocab: a list of tokens, the position of a token is its id in the runs
+		order: the order of the SLM
+
+	Returns:
+		packed: the PackedTransitions
+	"""
+	base = max(len(vocab), 1)
+	if base ** order >= 2 ** 63:
+		sys.exit("ERROR: The vocabulary is too large to pack contexts of order {} into 64 bits.".format(order))
+	new_line = vocab.index("\n") if "\n" in vocab else -1
+
+	contexts, offsets, next_ids, counts = array.array("q"), array.array("q", [0]), array.array("i"), array.array("q")
+	starts, start_counts = array.array("q"), array.array("q")
+	previous, previous_count, last_context = None, 0, None
+	# a sentinel row flushes the last ngram
+	for row in itertools.chain(heapq.merge(*[read_ngram_run(path) for path in paths]), [None]):
+		ngram = None if row is None else row[:-1]
+		if ngram == previous:
+			previous_count += row[-1]
+			continue
+
+		if previous is not None:
+			context = previous[:order]
+			if previous[0] == new_line and order > 1:
+				# the ("\n",) special case, see SLM.count_transitions
+				starts.extend(previous[1:])
+				start_counts.append(previous_count)
+			elif previous[0] == new_line:
+				# an SLM of order 1 counts the followers of "\n" twice
+				previous_count *= 2
+			if context != last_context:
+				contexts.extend(context)
+				offsets.append(offsets[-1])
+				last_context = context
+			next_ids.append(previous[order])
+			counts.append(previous_count)
+			offsets[-1] += 1
+		if row is not None:
+			previous, previous_count = ngram, row[-1]
+
+	powers = np.array([base ** (order - 1 - i) for i in range(order)], dtype=np.int64)
+	arrays = {
+		"context_keys": np.frombuffer(contexts, dtype=np.int64).reshape(-1, order) @ powers,
+		"offsets": np.frombuffer(offsets, dtype=np.int64).copy(),
+		"next_ids": np.frombuffer(next_ids, dtype=np.int32).copy(),
+		"cumulative": np.cumsum(np.frombuffer(counts, dtype=np.int64)),
+		"start_keys": np.frombuffer(starts, dtype=np.int64).reshape(-1, order) @ powers,
+		"start_cumulative": np.cumsum(np.frombuffer(start_counts, dtype=np.int64))
+	}
+	return PackedTransitions(list(vocab), order, arrays)
+
+
+def write_model_file(file, header, arrays):
+	"""
+	Writes a header and named arrays in the SLM binary format:
+	CACHE_MAGIC, a uint32 version and a uint32 header length, a json header that
+	also records the dtype/shape/offset of every array, then the raw arrays, each 
+	aligned to CACHE_ALIGNMENT bytes
+
+	Parameters:
+		file: a file opened in binary write mode
+		header: a json serializable dict
+		arrays: a dict of name -> numpy array
+	"""
+	header = dict(header, arrays={})
+	offset = 0
+	for name, array in arrays.items():
+		header["arrays"][name] = [array.dtype.str, list(array.shape), offset]
+		offset += -(-array.nbytes // CACHE_ALIGNMENT) * CACHE_ALIGNMENT
+	header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+	prefix_length = len(CACHE_MAGIC) + 8 + len(header_bytes)
+	header_bytes += b" " * (-prefix_length % CACHE_ALIGNMENT)
+
+	file.write(CACHE_MAGIC + struct.pack("<II", CACHE_VERSION, len(header_bytes)))
+	file.write(header_bytes)
+	for array in arrays.values():
+		data = np.ascontiguousarray(array).tobytes()
+		file.write(data + b"\0" * (-len(data) % CACHE_ALIGNMENT))
+
+
+def read_model_buffer(buffer):
+	"""
+	Reads a header and named arrays written by write_model_file from a buffer.
+	The arrays are read-only views over the buffer, nothing is copied.
+
+	Parameters:
+		buffer: a mmap (or any object supporting the buffer protocol)
 
-def train_multiple_models(path_list, SLM_parameter_list, train_size=100, chunk_size=250):
+	Returns:
+		(header, arrays): the json header and a dict of name -> numpy array, 
+						  or (None, None) if the buffer is not in the expected format
+						  or is cut short
+	"""
+	prefix_length = len(CACHE_MAGIC) + 8
+	if len(buffer) < prefix_length or bytes(buffer[:len(CACHE_MAGIC)]) != CACHE_MAGIC:
+		return None, None
+	version, header_length = struct.unpack("<II", bytes(buffer[len(CACHE_MAGIC):prefix_length]))
+	data_start = prefix_length + header_length
+	if version != CACHE_VERSION or len(buffer) < data_start:
+		return None, None
+
+	# a truncated file fails to decode or has arrays past its end
+	try:
+		header = json.loads(bytes(buffer[prefix_length:data_start]).decode("utf-8"))
+		arrays = {}
+		for name, (dtype, shape, offset) in header["arrays"].items():
+			count = int(np.prod(shape))
+			arrays[name] = np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + offset).reshape(shape)
+	except (ValueError, KeyError, TypeError):
+		return None, None
+	return header, arrays
+
+
+def live_contexts(counts, order):
+	"""
+	Finds the contexts a generation can always go on from: the largest set 
+	of contexts from which a walk that only moves between contexts of the set
+	can reach a follower in SENTENCE_END_TOKENS. Contexts that were never 
+	followed by anything (like the last ngram of the corpus) are never in it.
+
+	Parameters:
+		counts: a dict in the format of SLM.counts
+		order: the order of the model
+
+	Returns:
+		live: a set of ngram tuples
+	"""
+	# context -> the contexts its followers lead to, without the start special case
+	edges = {key: [key[1:] + words for words in followers] for key, followers in counts.items() 
+		if len(key) == order}
+	live = set(edges)
+	while True:
+		# walk backwards from the contexts that can end a sentence inside the set
+		previous = defaultdict(list)
+		reached = set()
+		for key in live:
+			for target in edges[key]:
+				if target in live:
+					previous[target].append(key)
+					if target[-1] in SENTENCE_END_TOKENS:
+						reached.add(key)
+		stack = list(reached)
+		while stack:
+			for key in previous[stack.pop()]:
+				if key not in reached:
+					reached.add(key)
+					stack.append(key)
+		if reached == live:
+			return live
+		live = reached
+
+
+def chunk_bounds(start, length, chunk_size):
+	"""
+	Splits the tokens from start to length into chunks of chunk_size tokens.
+	The last chunk takes the remainder, so it holds between chunk_size and 
+	2 * chunk_size tokens (or fewer if there was never a full chunk)
+
+	Returns:
+		bounds: a list of (start, end) of every chunk
+	"""
+	bounds = []
+	while (start < length):
+
+		end = start + chunk_size
+	
+		if end > length - chunk_size: 
+			# should just extend to the end
+			end = length
+
+		bounds.append((start, end))
+		start = end # increments chunk_size at a time
+	return bounds
+
+
+def worker_seeds(seed, workers):
+	"""
+	Returns one seed per worker process for SLM.seed or SLM.attach, spawned 
+	from seed with numpy's SeedSequence so the streams of the workers are 
+	independent of each other and reproducible from seed
+
+	Parameters:
+		seed: an int, None seeds from the system
+		workers: the number of seeds
+
+	Returns:
+		seeds: a list of ints
+	"""
+	return [int(child.generate_state(1, np.uint64)[0]) for child in np.random.SeedSequence(seed).spawn(workers)]
+
+
+def train_model(path, level, order, train_size=100, chunk_size=250, cache_dir=None, compact=False, prune=False):
+	"""
+	Trains one model, see train_multiple_models. Kept at module level so a
+	process pool can pickle it
+
+	Returns:
+		slm: the trained SLM, without its tokenized_list if compact
+	"""
+	slm = SLM(path, level, order)
+	slm.train(train_size, chunk_size, cache_dir, prune)
+	if compact:
+		slm.compact()
+		# the z score estimator is calibrated already, only the packed arrays are sent back
+		slm.tokenized_list = []
+	return slm
+
+
+def train_multiple_models(path_list, SLM_parameter_list, train_size=100, chunk_size=250, cache_dir=None, 
+	workers=1, compact=False, prune=False):
 	"""
 	Trains multiple models from the given list of corpora path.
 	There is an option to train on only a percentage of the corpora given.
 
+	With workers > 1 the models are trained in parallel in a pool of worker 
+	processes and sent back to this process. Passing compact=True packs them
+	(see SLM.compact) in the workers first and drops their tokenized_list, 
+	which makes them much smaller to send. Like the models loaded from the 
+	cache they then can't give the test portion of their corpus, tokenize 
+	the corpus again (see SLM.tokenize_file) where it is needed.
+
 	Parameters: 
 		path_list: a list of strings of the path to the corpora
 		SLM_parameter_list: parameters to initalize the SLMs
 		train_size (optinal): a number between 0 and 100 representing how much of the   
 							corpora should be trained fro the beginning
+		cache_dir (optional): directory to load/save trained models, see SLM.train.
+							  The models loaded from it have no tokenized_list, so
+							  they can't give the test portion of their corpus
+		workers (optional): the number of processes to train in, 1 trains in this process
+		compact (optional): whether to return the models in their compact representation, 
+							without their tokenized_list
+		prune (optional): whether to prune the dead ends of the models for generation, see SLM.train
 		
 	Returns:
 		model_list: the trained models as a list
@@ -436,22 +3027,19 @@ def train_multiple_models(path_list, SLM_parameter_list, train_size=100, chunk_s
 	path_len = len(path_list)
 	parameter_len = len(SLM_parameter_list)
 	
-	model_list = []
-
 	if (path_len != parameter_len):
 		sys.exit("ERROR: the sizes of path_list and SLM_parameter_list do not match.")
 
-	for i in range(path_len):
-		path = path_list[i]
-		level = SLM_parameter_list[i][0]
-		order = SLM_parameter_list[i][1]
+	levels = [parameters[0] for parameters in SLM_parameter_list]
+	orders = [parameters[1] for parameters in SLM_parameter_list]
+	arguments = (path_list, levels, orders, itertools.repeat(train_size), itertools.repeat(chunk_size), 
+		itertools.repeat(cache_dir), itertools.repeat(compact), itertools.repeat(prune))
 
-		slm = SLM(path, level, order)
-		slm.train(train_size, chunk_size)
-		
-		model_list.append(slm)
+	if workers > 1 and path_len > 1:
+		with ProcessPoolExecutor(max_workers=min(workers, path_len)) as executor:
+			return list(executor.map(train_model, *arguments))
 
-	return model_list
+	return list(map(train_model, *arguments))
 
 
 def estimate_tokenized_list_with_models(tokenized_list, model_list, chunk_size):
@@ -460,6 +3048,14 @@ def estimate_tokenized_list_with_models(tokenized_list, model_list, chunk_size):
 	calculates the z-scores with the estimate function of each model in model_list and return
 	the mean z-scores for the given tokenized_list associated with the models in model_list
 
+	The tokens are shared by all the models: each model scores the whole list 
+	once (see SLM.estimate_chunks) instead of retokenizing every chunk.
+	The scores differ from the ones of the first version of this function 
+	(by about 1e-2 on the quotes corpus), which joined every chunk and 
+	tokenized it again: its tokenizer dropped the word at the end of a 
+	string, so the last word of every chunk was left out of its likelihood
+	and size. Every token of a chunk counts now
+
 	Parameters:
 		tokenized_list: the list of tokens to be estimated by the z_score estimators of the models
 		model_list: the list of SLMs
@@ -468,48 +3064,58 @@ def estimate_tokenized_list_with_models(tokenized_list, model_list, chunk_size):
 	Returns:
 		mean_z_scores: a list of the mean z scores of the tokenized list estimated by the models 
 	"""
-	z_scores = []
-	# initalize lists to hold z-scores for each model
-	for i in range(len(model_list)):
-		z_scores.append([]) 
+	bounds = chunk_bounds(0, len(tokenized_list), chunk_size)
 
-	tokenized_length = len(tokenized_list)
+	# calculate means for each corpus
+	mean_z_scores = []
+	for model in model_list:
+		z_scores = model.estimate_chunks(tokenized_list, bounds).tolist()
+		mean_z_scores.append(sum(z_scores) / len(z_scores))
 
-	# iterate through the chunks
-	start = 0
-	while (start < tokenized_length):
+	return mean_z_scores
 
-		end = start + chunk_size
-	
-		if end > tokenized_length - chunk_size: 
-			# should just extend to the end
-			end = tokenized_length
-		
-		chunk_tokenized_list = tokenized_list[start: end]
-		chunk_text = (" ").join(chunk_tokenized_list)
-		
-		# estimate chunk text with all models
-		for i in range(len(model_list)):
-			res = model_list[i].estimate(chunk_text)    
-			z_scores[i].append(res) 
 
-		start = end # increments chunk_size at a time
+def z_score_matrix(model_list, tokenized_lists, chunk_size, workers=1):
+	"""
+	Computes the mean z scores of every tokenized text under every model, the 
+	matrix main() prints for the authorship attribution experiment. 
+	Every text is tokenized once by the caller and shared by all the models.
 
-	# calculate means for each corpus
-	mean_z_scores = []
-	for i in range(len(z_scores)):
-		tmp_mean_z_score = sum(z_scores[i]) / len(z_scores[i])
-		mean_z_scores.append(tmp_mean_z_score)
+	Parameters:
+		model_list: the list of SLMs
+		tokenized_lists: the list of tokenized texts to be estimated
+		chunk_size: chunk to split each tokenized text
+		workers (optional): the number of processes to score in, one model per task
 
-	return mean_z_scores
+	Returns:
+		z_mean_scores: a list with one row per tokenized text and one column per model
+	"""
+	arguments = (model_list, itertools.repeat(tokenized_lists), itertools.repeat(chunk_size))
+	if workers > 1 and len(model_list) > 1:
+		with ProcessPoolExecutor(max_workers=min(workers, len(model_list))) as executor:
+			columns = list(executor.map(estimate_tokenized_lists_with_model, *arguments))
+	else:
+		columns = list(map(estimate_tokenized_lists_with_model, *arguments))
+
+	# transpose to one row per tokenized text
+	return [list(row) for row in zip(*columns)]
+
+
+def estimate_tokenized_lists_with_model(model, tokenized_lists, chunk_size):
+	"""
+	Helper function for z_score_matrix
+	Returns the mean z score of every tokenized text under one model
+	"""
+	return [estimate_tokenized_list_with_models(tokenized_list, [model], chunk_size)[0] 
+		for tokenized_list in tokenized_lists]
 
 
-def train_markov(path):
+def train_markov(path, cache_dir="./model_cache"):
 	path_list = [path]
 	SLM_parameter_list = [["word", 3]]
 	train_size = 90 #80%
 	chunk_size = 500
-	model_list = train_multiple_models(path_list, SLM_parameter_list, train_size, chunk_size)
+	model_list = train_multiple_models(path_list, SLM_parameter_list, train_size, chunk_size, cache_dir, prune=True)
 	return model_list[0]
 
 
@@ -536,18 +3142,14 @@ def main():
 	chunk_size = 500
 	model_list = train_multiple_models(path_list, SLM_parameter_list, train_size, chunk_size)
 
-	z_mean_scores = []
-	# iterate thorugh each corpus
+	# uses the last 20% of every corpus as its test portion
+	test_portions = []
 	for model in model_list:
 		corpus_tokenized_list = model.tokenized_list
+		start = int(len(corpus_tokenized_list) * train_size / 100) 
+		test_portions.append(corpus_tokenized_list[start:])
 
-		corpus_length = len(corpus_tokenized_list)
-		# iterate through the chunks
-		start = int(corpus_length * train_size / 100) 
-		test_portion_text = corpus_tokenized_list[start:] # uses the last 20% of the text
-
-		tmp_z_mean_scores = estimate_tokenized_list_with_models(test_portion_text, model_list, chunk_size)
-		z_mean_scores.append(tmp_z_mean_scores)
+	z_mean_scores = z_score_matrix(model_list, test_portions, chunk_size)
 	print("\n----Mean Z Scores Matrix----\n")
 	print(z_mean_scores)
 